@@ -0,0 +1,211 @@
+"""Benchmarks of schedule imports on generated workbooks
+
+Times the import phases against in-memory SQLite databases, the moodle
+one filled with generated courses. Workbooks and courses depend only on
+the size and seed, and every phase keeps its best time of --repeat runs,
+so results of different commits can be compared:
+
+    python -m benchmarks.run --size medium --output before.json
+    python -m benchmarks.run --size medium --compare before.json
+"""
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import django
+
+SIZES = {
+    'small': dict(groups=30, lessons_per_day=5, subjects=60, courses=500),
+    'medium': dict(groups=120, lessons_per_day=6, subjects=150,
+                   courses=2000),
+    'large': dict(groups=300, lessons_per_day=7, subjects=300, courses=5000),
+}
+
+
+def setup_django():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+    django.setup()
+
+    from django.apps import apps
+    from django.core.management import call_command
+    from django.db import connections
+
+    call_command('migrate', run_syncdb=True, verbosity=0)
+    # Moodle tables are not managed by the project
+    with connections['moodle'].schema_editor() as editor:
+        for model in apps.get_app_config('moodle').get_models():
+            if not model._meta.managed:
+                editor.create_model(model)
+
+
+def fill_database(subjects, courses, seed):
+    """Create reference rows and Moodle courses, return faculty, semester"""
+    from main import models
+    from moodle.models import MdlCourse
+    from benchmarks.workbook import SUBJECT_WORDS, subject_names
+
+    models.LessonNumber.objects.bulk_create(
+        models.LessonNumber(lesson_number=number,
+                            starttime=datetime.time(7 + number, 30),
+                            endtime=datetime.time(8 + number, 50))
+        for number in range(1, 9))
+    faculty = models.Faculty.objects.create(name='Benchmark faculty')
+    semester = models.Semester.objects.create(
+        startdate=datetime.date(2026, 9, 1),
+        enddate=datetime.date(2026, 12, 25),
+        weektype=models.Semester.WeekType.NUMERATOR)
+
+    # courses for most subjects, named the way Moodle courses are, and
+    # unrelated courses of other faculties
+    rnd = random.Random(seed)
+    mdl_courses = list()
+    for name in subject_names(subjects, seed):
+        if rnd.random() < 0.8:
+            mdl_courses.append(MdlCourse(
+                shortname=f'{name} ({rnd.randint(2020, 2026)})',
+                fullname=f'{name} для спеціальності {rnd.randint(100, 300)}'))
+    while len(mdl_courses) < courses:
+        words = rnd.sample(SUBJECT_WORDS, rnd.randint(2, 5))
+        mdl_courses.append(MdlCourse(shortname=' '.join(words[:2]),
+                                     fullname=' '.join(words)))
+    for number, course in enumerate(mdl_courses):
+        course.timemodified = 1700000000 + number
+    MdlCourse.objects.bulk_create(mdl_courses)
+
+    return faculty, semester
+
+
+def clear_import():
+    from main import models
+
+    for model in (models.Lesson, models.Group, models.Specialty,
+                  models.Subject):
+        model.objects.all().delete()
+
+
+def run_import(path, faculty, semester):
+    """Run one import of the workbook
+
+    Returns:
+        Tuple[Dict[str, float], Dict[str, int]]: seconds by phase, counts
+    """
+    from django.db import connections
+    from django.test.utils import CaptureQueriesContext
+    from main.schedule_file_parser import (CourseMatcher, Lesson,
+                                           ScheduleFileParser, ScheduleSheet)
+
+    phases, counts = dict(), dict()
+
+    def timed(name, function):
+        gc.collect()
+        started = time.perf_counter()
+        result = function()
+        phases[name] = time.perf_counter() - started
+        return result
+
+    timed('load_streaming', lambda: ScheduleSheet(path, streaming=True))
+    sheet = timed('load', lambda: ScheduleSheet(path))
+    schedule = timed('read_schedule', sheet.read_schedule)
+
+    titles = set()
+    for _, _, _, lesson_info, _ in schedule['lessons']:
+        titles.add(Lesson.split_info(lesson_info)[0])
+    course_matcher = CourseMatcher()
+    timed('find_course',
+          lambda: [course_matcher.find_id(title) for title in sorted(titles)])
+
+    default_queries = CaptureQueriesContext(connections['default'])
+    with default_queries:
+        parser = timed('parse_lessons', lambda: ScheduleFileParser(
+            None, faculty, semester, schedule,
+            course_matcher=course_matcher))
+        timed('serialize', parser.serialize_to_db)
+        timed('reimport', lambda: ScheduleFileParser(
+            None, faculty, semester, schedule,
+            course_matcher=course_matcher).serialize_to_db(incremental=True))
+
+    # matches stored by the import are reused by later imports
+    stored_matcher = CourseMatcher()
+    timed('find_course_stored',
+          lambda: [stored_matcher.find_id(title) for title in sorted(titles)])
+
+    counts.update(cells=len(schedule['lessons']), lessons=len(parser.lessons),
+                  subjects=len(titles), courses=len(course_matcher.courses),
+                  queries=len(default_queries))
+    return phases, counts
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    arg_parser.add_argument('--size', choices=SIZES, default='medium')
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--output', help='write results to a JSON file')
+    arg_parser.add_argument('--compare',
+                            help='JSON file of a previous run to compare with')
+    args = arg_parser.parse_args(argv)
+
+    setup_django()
+    from benchmarks.workbook import generate_workbook
+
+    size = SIZES[args.size]
+    faculty, semester = fill_database(size['subjects'], size['courses'],
+                                      args.seed)
+
+    phases, counts = dict(), dict()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'schedule.xlsx')
+        generate_workbook(path, groups=size['groups'],
+                          lessons_per_day=size['lessons_per_day'],
+                          subjects=size['subjects'], seed=args.seed)
+        for _ in range(args.repeat):
+            run_phases, counts = run_import(path, faculty, semester)
+            for name, seconds in run_phases.items():
+                phases[name] = min(seconds, phases.get(name, seconds))
+            clear_import()
+
+    result = dict(commit=git_commit(), python=platform.python_version(),
+                  size=args.size, seed=args.seed, repeat=args.repeat,
+                  params=size, counts=counts, phases=phases)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as compare_file:
+            previous = json.load(compare_file)
+
+    print(f'size {args.size}, commit {result["commit"]}, '
+          f'best of {args.repeat}')
+    for name, value in counts.items():
+        print(f'  {name:<20}{value:>12}')
+    for name, seconds in phases.items():
+        line = f'  {name:<20}{seconds:>11.3f}s'
+        if previous and name in previous.get('phases', {}):
+            before = previous['phases'][name]
+            line += f'  was {before:.3f}s ({seconds / before:.2f}x)' \
+                if before else f'  was {before:.3f}s'
+        print(line)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(result, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
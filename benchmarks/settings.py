@@ -0,0 +1,25 @@
+"""Settings for benchmarks: project settings with in-memory SQLite databases
+
+The moodle database is an in-process stand-in filled by benchmarks.run.
+"""
+import os
+
+for name in ('SECRET_KEY', 'SCHEDULE_DB_USER', 'SCHEDULE_DB_PASSWORD',
+             'SCHEDULE_DB_HOST', 'SCHEDULE_DB_PORT', 'MOODLE_DB_USER',
+             'MOODLE_DB_PASSWORD', 'MOODLE_DB_HOST', 'MOODLE_DB_PORT'):
+    os.environ.setdefault(name, 'benchmark')
+
+from schedule_nubip.settings import *  # noqa: E402,F401,F403
+
+DEBUG = False
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    },
+    'moodle': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    },
+}
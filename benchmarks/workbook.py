@@ -0,0 +1,109 @@
+"""Synthetic faculty timetables in the NUBIP schedule layout
+
+Faculty name in Q1, course, specialty and group rows 3-5, week days as
+merged blocks in column A and lesson numbers in column B, two rows per
+lesson. A lesson takes both rows of its cell, a numerator/denominator
+pair takes one row each, lectures are merged across several groups.
+"""
+import random
+
+from openpyxl import Workbook
+
+from main.schedule_file_parser import (COURSES_ROW, DAYS_START_ROW,
+                                       FACULTY_NAME_CELL, GROUP_ROW,
+                                       LESSON_NUMBER_COLUMN, SPECIALTY_ROW,
+                                       TITLE_COLUMNS)
+
+WEEK_DAYS = ['Понеділок', 'Вівторок', 'Середа', 'Четвер', 'Пʼятниця',
+             'Субота']
+
+SUBJECT_WORDS = ['Вища', 'математика', 'Фізика', 'Програмування', 'Бази',
+                 'даних', 'Економіка', 'Історія', 'України', 'Іноземна',
+                 'мова', 'Основи', 'аналіз', 'Комп\'ютерні', 'мережі',
+                 'Теорія', 'ймовірностей', 'Операційні', 'системи',
+                 'Філософія', 'Екологія', 'Алгоритми', 'структури']
+
+GROUPS_PER_SPECIALTY = 6
+SPECIALTIES_PER_COURSE = 4
+
+
+def subject_names(count, seed=0):
+    """Return count distinct subject names, the same for the same seed"""
+    rnd = random.Random(seed)
+    names = set()
+    while len(names) < count:
+        words = rnd.sample(SUBJECT_WORDS, rnd.randint(1, 4))
+        names.add(' '.join(words).capitalize())
+    return sorted(names)
+
+
+def generate_workbook(path, groups=60, lessons_per_day=6, days=5,
+                      subjects=80, seed=0):
+    """Write a faculty timetable workbook
+
+    Args:
+        groups (int): number of group columns
+        lessons_per_day (int): lesson numbers of a week day
+        days (int): week days starting from Monday
+        subjects (int): number of distinct subject names
+        seed (int): the same arguments and seed give the same workbook
+    """
+    rnd = random.Random(seed)
+    names = subject_names(subjects, seed)
+
+    wb = Workbook()
+    ws = wb.active
+    ws[FACULTY_NAME_CELL] = 'Факультет інформаційних технологій'
+
+    first_column = TITLE_COLUMNS + 1
+    last_column = TITLE_COLUMNS + groups
+    for index in range(groups):
+        column = first_column + index
+        specialty = index // GROUPS_PER_SPECIALTY
+        ws.cell(COURSES_ROW, column,
+                f'{specialty // SPECIALTIES_PER_COURSE % 4 + 1} курс')
+        ws.cell(SPECIALTY_ROW, column, str(121 + specialty))
+        number = index % GROUPS_PER_SPECIALTY + 1
+        ws.cell(GROUP_ROW, column,
+                f'{number} група' + (' (с.т.)' if number == 6 else ''))
+
+    def lesson_text(kind):
+        return f'{rnd.choice(names)} ({kind})\n' \
+               f'{rnd.randint(1, 15)} к. {rnd.randint(100, 450)}'
+
+    row = DAYS_START_ROW
+    for week_day in WEEK_DAYS[:days]:
+        day_row = row
+        for number in range(1, lessons_per_day + 1):
+            ws.cell(row, LESSON_NUMBER_COLUMN, number)
+            ws.merge_cells(start_row=row, end_row=row + 1,
+                           start_column=LESSON_NUMBER_COLUMN,
+                           end_column=LESSON_NUMBER_COLUMN)
+            column = first_column
+            while column <= last_column:
+                width = min(rnd.choice([1, 1, 1, 2, 3, 6]),
+                            last_column - column + 1)
+                end_column = column + width - 1
+                kind = rnd.random()
+                if kind < 0.55:  # each week
+                    ws.cell(row, column, lesson_text('л' if width > 1
+                                                     else 'пр'))
+                    ws.merge_cells(start_row=row, end_row=row + 1,
+                                   start_column=column, end_column=end_column)
+                elif kind < 0.8:  # numerator and denominator
+                    for pair_row in (row, row + 1):
+                        ws.cell(pair_row, column, lesson_text('лаб'))
+                        if width > 1:
+                            ws.merge_cells(start_row=pair_row,
+                                           end_row=pair_row,
+                                           start_column=column,
+                                           end_column=end_column)
+                elif kind < 0.9:  # numerator only
+                    ws.cell(row, column, lesson_text('пр'))
+                column = end_column + 1
+            row += 2
+        ws.cell(day_row, 1, week_day)
+        ws.merge_cells(start_row=day_row, end_row=row - 1,
+                       start_column=1, end_column=1)
+
+    wb.save(path)
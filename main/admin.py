@@ -1,7 +1,8 @@
 from django.contrib import admin
 from django.shortcuts import redirect
 
-from main.models import (Faculty, Group, Lesson, Semester, ScheduleFile,
+from main.models import (CalendarFeed, CalendarSyncJob, Faculty, Group,
+                         Lesson, LessonChange, Semester, ScheduleFile,
                          LessonNumber, Subject, Specialty, Type)
 
 
@@ -15,23 +16,57 @@ def set_meeting_url(modeladmin, request, queryset):
 def make_practice(modeladmin, request, queryset):
     ids = list(queryset.values_list('id', flat=True))
     Lesson.objects.filter(id__in=ids).update(type=Type.PRACTICE)
+    LessonChange.record(ids)
 
 
 @admin.action(description='Mark as Lecture', permissions=['change'])
 def make_lecture(modeladmin, request, queryset):
     ids = list(queryset.values_list('id', flat=True))
     Lesson.objects.filter(id__in=ids).update(type=Type.LECTURE)
+    LessonChange.record(ids)
 
 
 class SubjectAdmin(admin.ModelAdmin):
     search_fields = ('title',)
 
+    # lessons of the subject move to the users of its new course
+    def save_model(self, request, obj, form, change):
+        lesson_ids = list(obj.lesson_set.values_list('id', flat=True)) \
+            if change else []
+        LessonChange.record(lesson_ids)
+        super().save_model(request, obj, form, change)
+        LessonChange.record(lesson_ids)
+
 
 class LessonAdmin(admin.ModelAdmin):
     search_fields = ('subject__title',)
     list_filter = ('type', 'dayofweek', 'lesson_number', 'groups',)
     actions = [make_lecture, make_practice, set_meeting_url]
 
+    # calendars and feeds of the lesson groups and course are updated,
+    # those of before the change too
+    def save_model(self, request, obj, form, change):
+        if change:
+            LessonChange.record([obj.pk])
+        super().save_model(request, obj, form, change)
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        LessonChange.record([form.instance.pk])
+
+    def delete_model(self, request, obj):
+        LessonChange.record([obj.pk])
+        super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        LessonChange.record(list(queryset.values_list('id', flat=True)))
+        super().delete_queryset(request, queryset)
+
+
+class CalendarFeedAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'token', 'created_at')
+    readonly_fields = ('token',)
+
 
 admin.site.register(Faculty)
 admin.site.register(Group)
@@ -41,4 +76,6 @@ admin.site.register(Semester)
 admin.site.register(ScheduleFile)
 admin.site.register(Subject, SubjectAdmin)
 admin.site.register(Specialty)
+admin.site.register(CalendarSyncJob)
+admin.site.register(CalendarFeed, CalendarFeedAdmin)
 admin.site.site_header = 'NUBIP Schedule administration'
@@ -0,0 +1,211 @@
+"""iCalendar feeds of lessons, subscribed instead of pushed to Google
+
+Feeds have the events of g_calendar.Event, so a subscribed calendar shows
+the same lessons as a calendar updated through the API. Conditional
+requests are answered from ScheduleVersion without reading lessons, and
+generated feeds are cached under their ETag, so a lesson change of the
+feed groups or courses, or a Moodle snapshot refresh, gives a new feed.
+"""
+from datetime import datetime, time, timedelta, timezone
+from typing import Optional
+import hashlib
+import json
+
+from django.core.cache import cache
+from django.db.models import Max
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from main import models
+from main.g_calendar import (Event, GroupSchedule, PersonBase, Teacher,
+                             create_person)
+
+FEED_CACHE_SECONDS = 24 * 60 * 60
+
+CONTENT_TYPE = 'text/calendar; charset=utf-8'
+
+LINE_LENGTH = 75  # octets of a content line, longer lines are folded
+
+TIME_ZONE = 'Europe/Kyiv'
+
+VTIMEZONE = [
+    'BEGIN:VTIMEZONE',
+    f'TZID:{TIME_ZONE}',
+    'BEGIN:STANDARD',
+    'DTSTART:19701025T040000',
+    'TZOFFSETFROM:+0300',
+    'TZOFFSETTO:+0200',
+    'TZNAME:EET',
+    'RRULE:FREQ=YEARLY;BYMONTH=10;BYDAY=-1SU',
+    'END:STANDARD',
+    'BEGIN:DAYLIGHT',
+    'DTSTART:19700329T030000',
+    'TZOFFSETFROM:+0200',
+    'TZOFFSETTO:+0300',
+    'TZNAME:EEST',
+    'RRULE:FREQ=YEARLY;BYMONTH=3;BYDAY=-1SU',
+    'END:DAYLIGHT',
+    'END:VTIMEZONE',
+]
+
+
+def feed_person(feed: models.CalendarFeed) -> Optional[PersonBase]:
+    """Person whose lessons are in the feed, None if it is not found"""
+    if feed.group_id:
+        return GroupSchedule(feed.group)
+
+    if feed.teacher_id:
+        mdl_user = (models.MoodleUser.objects.filter(pk=feed.teacher_id)
+                    .first())
+        return Teacher(None, mdl_user) if mdl_user else None
+
+    # the email of the last calendar update, as calendar_sync_all does
+    job = (models.CalendarSyncJob.objects.filter(user=feed.user)
+           .order_by('-pk').first())
+    email = job.email if job else feed.user.email
+    mdl_user = models.MoodleUser.objects.filter(email=email).first()
+    return create_person(feed.user, mdl_user) if mdl_user else None
+
+
+def feed_version(feed: models.CalendarFeed, person: PersonBase):
+    """ETag and the last change of the feed lessons
+
+    Returns:
+        Tuple[str, Optional[datetime]]: quoted ETag and when lessons of the
+        feed groups or courses changed or a semester ended last
+    """
+    groups, _ = person.audience_groups()
+    groups, course_ids = sorted(set(groups)), \
+        sorted(set(person.enrolled_course_ids))
+    changed_at = models.ScheduleVersion.last_changed(groups, course_ids)
+    # lessons of a semester leave the feed the day after it ends
+    today = datetime.now().date()
+    semesters = sorted(models.Semester.objects.filter(enddate__gte=today)
+                       .values_list('pk', flat=True))
+    last_ended = models.Semester.objects.filter(enddate__lt=today).aggregate(
+        Max('enddate'))['enddate__max']
+    if last_ended:
+        ended_at = datetime.combine(last_ended + timedelta(days=1),
+                                    time.min).astimezone(timezone.utc)
+        changed_at = max(changed_at or ended_at, ended_at)
+    # Moodle data of the feed, like teacher names, changes with the snapshot
+    snapshot = models.MoodleSnapshot.version()
+    version = json.dumps([feed.token, groups, course_ids, semesters,
+                          changed_at.isoformat() if changed_at else None,
+                          snapshot.isoformat() if snapshot else None])
+    return f'"{hashlib.sha1(version.encode()).hexdigest()}"', changed_at
+
+
+def feed_response(request, feed: models.CalendarFeed, person: PersonBase):
+    """Feed response, 304 if the client has the current version"""
+    etag, changed_at = feed_version(feed, person)
+    last_modified = int(changed_at.timestamp()) if changed_at else None
+
+    response = get_conditional_response(request, etag=etag,
+                                        last_modified=last_modified)
+    if response is None:
+        key = 'calendar_feed:' + etag.strip('"')
+        body = cache.get(key)
+        if body is None:
+            response = StreamingHttpResponse(
+                cached(key, feed_chunks(person, str(feed), changed_at)),
+                content_type=CONTENT_TYPE)
+        else:
+            response = HttpResponse(body, content_type=CONTENT_TYPE)
+
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+def cached(key, chunks):
+    """Yield the chunks and cache them joined when all are sent"""
+    body = list()
+    for chunk in chunks:
+        body.append(chunk)
+        yield chunk
+    cache.set(key, ''.join(body), FEED_CACHE_SECONDS)
+
+
+def feed_chunks(person: PersonBase, name, changed_at=None):
+    """Yield the feed calendar, an event per chunk
+
+    Lessons of semesters that are not over are read in chunks of rows.
+    """
+    stamp = format_utc(changed_at or datetime.now(timezone.utc))
+    yield content(['BEGIN:VCALENDAR',
+                   'VERSION:2.0',
+                   'PRODID:-//NUBIP Schedule//Lessons//UK',
+                   'CALSCALE:GREGORIAN',
+                   'METHOD:PUBLISH',
+                   f'X-WR-CALNAME:{escape(name)}',
+                   f'X-WR-TIMEZONE:{TIME_ZONE}'] + VTIMEZONE)
+
+    lessons = person.search_lessons().filter(
+        semester__enddate__gte=datetime.now().date())
+    lesson_ids = set()
+    for lesson in lessons.iterator(chunk_size=500):
+        if lesson.id in lesson_ids:
+            continue  # found by several groups
+        lesson_ids.add(lesson.id)
+        event = Event.create_from_lesson(lesson)
+        event.description = person.build_description(lesson)
+        yield content(event_lines(event, stamp))
+
+    yield content(['END:VCALENDAR'])
+
+
+def event_lines(event: Event, stamp):
+    return ['BEGIN:VEVENT',
+            f'UID:{event.uuid}',
+            f'DTSTAMP:{stamp}',
+            f'DTSTART;TZID={TIME_ZONE}:{format_local(event.start_date_time)}',
+            f'DTEND;TZID={TIME_ZONE}:{format_local(event.end_date_time)}',
+            rrule(event),
+            f'SUMMARY:{escape(event.summary)}',
+            f'LOCATION:{escape(event.location)}',
+            f'DESCRIPTION:{escape(event.description)}',
+            'END:VEVENT']
+
+
+def rrule(event: Event):
+    """Event.rrule with UNTIL a UTC date-time, the value type of DTSTART"""
+    return (f'RRULE:FREQ=WEEKLY;INTERVAL={event.interval};'
+            f'UNTIL={event.until.strftime("%Y%m%d")}T235959Z')
+
+
+def content(lines):
+    return ''.join(f'{fold(line)}\r\n' for line in lines)
+
+
+def fold(line: str):
+    """Split a line longer than LINE_LENGTH octets into continuation lines"""
+    if len(line.encode()) <= LINE_LENGTH:
+        return line
+
+    parts, part, size = list(), '', 0
+    for char in line:
+        char_size = len(char.encode())
+        if size + char_size > LINE_LENGTH:
+            parts.append(part)
+            part, size = ' ', 1  # continuation lines start with a space
+        part += char
+        size += char_size
+    parts.append(part)
+    return '\r\n'.join(parts)
+
+
+def escape(text: str):
+    return (text.replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\n', '\\n'))
+
+
+def format_local(value: datetime):
+    """Wall time of the lesson, lessons are in TIME_ZONE"""
+    return value.strftime('%Y%m%dT%H%M%S')
+
+
+def format_utc(value: datetime):
+    return value.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
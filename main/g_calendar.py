@@ -1,29 +1,258 @@
 from __future__ import print_function
-from collections import defaultdict
-from datetime import datetime, timedelta
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta, timezone
 from typing import Dict
+import hashlib
+import json
+import random
+import threading
+import time
 import uuid
 
+from google.oauth2 import service_account
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
 from googleapiclient.errors import HttpError
 from google.auth.exceptions import RefreshError
+from httplib2 import Http
 
 from allauth.socialaccount.models import SocialToken
+from django.db import transaction
+from django.db.models import Q, Count
 
 from main import models
-from moodle.models import (
-    MdlUserEnrolments, MdlCohortMembers, MdlRoleAssignments)
-from schedule_nubip.settings import DEBUG
+from schedule_nubip.settings import DEBUG, GOOGLE_SERVICE_ACCOUNT_FILE
 
 SOURCE_NAME = 'scheduleNUBIP'
 
+BATCH_SIZE = 50  # requests in one Calendar API batch, the API limit is 50
+
+IDENTIFIER_EXISTS = 'The requested identifier already exists.'
+
+EVENTS_PAGE_SIZE = 2500  # maximum events in a list response
+
+GOOGLE_TOKEN_URI = 'https://oauth2.googleapis.com/token'
+
+SERVICES_PER_THREAD = 256  # Calendar API services kept for reuse
+
+FAN_OUT_CHANGES = 1000  # lesson changes read by fan_out_lesson_changes
+
+# how often update_calendar compares lessons with the calendar events
+# instead of the events stored in PushedEvent
+RECONCILE_INTERVAL = timedelta(days=1)
+
+# how long teacher names of courses are reused without a snapshot refresh
+COURSE_TEACHERS_TTL = timedelta(hours=1)
+
+# the service account owns group calendars and shares them with students
+SERVICE_ACCOUNT_SCOPES = ['https://www.googleapis.com/auth/calendar']
+
+QUOTA_RETRIES = 5  # resends of requests rejected by Calendar API rate limits
+QUOTA_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
 
 class CalendarException(Exception):
     def __init__(self, *args: object) -> None:
         super().__init__(*args)
 
 
+class SocialTokenCredentials(Credentials):
+    """Google credentials of a SocialToken, saving refreshed access tokens
+
+    Passing the token expiry lets google-auth refresh an expired token
+    before the request instead of after a 401 response.
+    """
+
+    def __init__(self, social_token: SocialToken):
+        expiry = social_token.expires_at
+        if expiry:  # google-auth uses naive UTC time
+            expiry = expiry.astimezone(timezone.utc).replace(tzinfo=None)
+        super().__init__(token=social_token.token,
+                         refresh_token=social_token.token_secret or None,
+                         token_uri=GOOGLE_TOKEN_URI,
+                         client_id=social_token.app.client_id,
+                         client_secret=social_token.app.secret,
+                         expiry=expiry)
+        self.social_token = social_token
+
+    def refresh(self, request):
+        super().refresh(request)
+        self.social_token.token = self.token
+        self.social_token.expires_at = \
+            self.expiry.replace(tzinfo=timezone.utc) if self.expiry else None
+        self.social_token.save(update_fields=['token', 'expires_at'])
+
+    def matches(self, social_token: SocialToken):
+        return (self.social_token.pk == social_token.pk and
+                self.token == social_token.token and
+                self.refresh_token == (social_token.token_secret or None))
+
+
+calendar_discovery = None  # parsed discovery document of Calendar API v3
+discovery_lock = threading.Lock()
+local = threading.local()  # API services of a thread, not thread-safe
+rate_limiter = None  # RateLimiter of API requests, set by calendar_sync_all
+
+
+class CourseTeachers:
+    """Teacher names of all courses, shared by the users of the process
+
+    Names are loaded from the Moodle snapshot tables with one query per
+    table and loaded again after COURSE_TEACHERS_TTL or when the snapshot
+    is refreshed.
+    """
+
+    def __init__(self, ttl=COURSE_TEACHERS_TTL):
+        self.ttl = ttl
+        self.names = None  # course id -> teacher names
+        self.version = None  # MoodleSnapshot.version() of the names
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def get(self) -> Dict[int, list]:
+        with self.lock:
+            now = datetime.now(timezone.utc)
+            version = models.MoodleSnapshot.version()
+            if (self.names is None or version != self.version or
+                    now - self.loaded_at > self.ttl):
+                self.names, self.version, self.loaded_at = \
+                    self.load(), version, now
+            return self.names
+
+    @staticmethod
+    def load():
+        teacher_ids = (models.MoodleRoleAssignment.objects
+                       .filter(role='editingteacher').values('user_id'))
+        user_names = {user.pk: str(user) for user in
+                      models.MoodleUser.objects.filter(pk__in=teacher_ids)}
+
+        names = defaultdict(list)
+        for course_id, user_id in (
+            models.MoodleEnrolment.objects
+            .filter(user_id__in=teacher_ids, status=0)
+            .values_list('course_id', 'user_id').distinct()
+        ):
+            if user_id in user_names:
+                names[course_id].append(user_names[user_id])
+        for course_names in names.values():
+            course_names.sort()
+        return dict(names)
+
+
+course_teachers = CourseTeachers()  # used by CourseTeachersDescription
+
+
+class RateLimiter:
+    """Token bucket limiting Calendar API requests of all threads
+
+    Every call reserves its requests and waits for its turn, so threads
+    are served in call order. A thread sends one batch of a user at a
+    time, users of a large calendar wait behind the batches of the others
+    instead of taking the whole quota.
+    """
+
+    def __init__(self, rate, burst=BATCH_SIZE):
+        self.rate = rate  # requests per second
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, requests=1):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= requests  # negative while requests wait
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+def throttle(requests=1):
+    """Wait until the requests are allowed by rate_limiter"""
+    if rate_limiter is not None:
+        rate_limiter.acquire(requests)
+
+
+def is_quota_error(error):
+    """Whether the request was rejected by a Calendar API rate limit"""
+    if not isinstance(error, HttpError):
+        return False
+    if error.resp.status == 429:
+        return True
+    details = error.error_details if isinstance(error.error_details,
+                                                list) else []
+    return error.resp.status == 403 and any(
+        isinstance(detail, dict) and detail.get('reason') in QUOTA_REASONS
+        for detail in details)
+
+
+def quota_backoff(attempt):
+    """Exponential backoff with jitter before a resend, in seconds"""
+    return (1 + random.random()) * 2 ** attempt
+
+
+def discovery_document():
+    """Static discovery document of Calendar API, parsed once per process
+
+    Services add the library parameters to the method descriptions of the
+    document when their resources are first used. A service is built and
+    all its resources are used before the document is shared, so threads
+    never see it change size.
+    """
+    global calendar_discovery
+    with discovery_lock:
+        if calendar_discovery is None:
+            document = json.loads(
+                discovery_cache.get_static_doc('calendar', 'v3'))
+            # no requests are sent, the service needs no credentials
+            use_resources(build_from_document(document, http=Http()),
+                          document)
+            calendar_discovery = document
+    return calendar_discovery
+
+
+def use_resources(resource, description):
+    for name, nested in description.get('resources', dict()).items():
+        use_resources(getattr(resource, name)(), nested)
+
+
+def calendar_service(social_token: SocialToken):
+    """Calendar API service authorized with the token
+
+    Services are reused by the thread while the stored token is the one
+    they use.
+    """
+    services = getattr(local, 'services', None)
+    if services is None:
+        services = local.services = OrderedDict()  # least recent first
+
+    credentials, service = services.get(social_token.pk, (None, None))
+    if not credentials or not credentials.matches(social_token):
+        credentials = SocialTokenCredentials(social_token)
+        service = build_from_document(discovery_document(),
+                                      credentials=credentials)
+    services[social_token.pk] = (credentials, service)
+    services.move_to_end(social_token.pk)
+    while len(services) > SERVICES_PER_THREAD:
+        services.popitem(last=False)
+    return service
+
+
+def service_account_service():
+    """Calendar API service of the service account owning group calendars"""
+    service = getattr(local, 'service_account', None)
+    if service is None:
+        credentials = service_account.Credentials.from_service_account_file(
+            GOOGLE_SERVICE_ACCOUNT_FILE, scopes=SERVICE_ACCOUNT_SCOPES)
+        service = local.service_account = build_from_document(
+            discovery_document(), credentials=credentials)
+    return service
+
+
 class Event:
 
     @staticmethod
@@ -48,6 +277,7 @@ class Event:
     def create_from_lesson(lesson: models.Lesson) -> 'Event':
         new_event = Event()
 
+        new_event.id = None  # given by Google when the event is created
         new_event.uuid = lesson.id
         new_event.summary = lesson.subject.title
         new_event.location = lesson.location
@@ -60,6 +290,17 @@ class Event:
 
         return new_event
 
+    @staticmethod
+    def create_from_pushed(pushed: models.PushedEvent) -> 'Event':
+        new_event = Event()
+
+        new_event.id = pushed.event_id
+        new_event.uuid = pushed.lesson_id
+        new_event.summary = str(pushed.lesson_id)
+        new_event.until = pushed.until
+
+        return new_event
+
     @staticmethod
     def parse_dates(start: str, end: str):
         start_date_time, end_date_time = None, None
@@ -101,24 +342,29 @@ class Event:
 
         return interval, until
 
-    def api_create(self, service):
-        print(f'Creating event {self.summary}')
-        try:
-            service.events().import_(calendarId='primary',
-                                     body=self._event_dict).execute()
-        except HttpError as error:
-            if error.reason == 'The requested identifier already exists.':
-                self.api_update(service)
-
-    def api_update(self, service):
-        print(f'Updating event {self.summary}')
-        service.events().update(calendarId='primary', eventId=self.id,
-                                body=self._event_dict).execute()
-
-    def api_delete(self, service):
-        print(f'deleting event {self.summary}')
-        service.events().delete(calendarId='primary', eventId=self.id,
-                                sendNotifications=False).execute()
+    def api_create(self, service, calendar_id='primary'):
+        return service.events().import_(calendarId=calendar_id,
+                                        body=self._event_dict)
+
+    def api_update(self, service, calendar_id='primary'):
+        return service.events().update(calendarId=calendar_id,
+                                       eventId=self.id, body=self._event_dict)
+
+    def api_delete(self, service, calendar_id='primary'):
+        return service.events().delete(calendarId=calendar_id,
+                                       eventId=self.id,
+                                       sendNotifications=False)
+
+    def api_find(self, service, calendar_id='primary'):
+        return service.events().list(calendarId=calendar_id,
+                                      iCalUID=str(self.uuid),
+                                      showDeleted=True)
+
+    @property
+    def fingerprint(self):
+        """Identifies the content of the event sent to the API"""
+        return hashlib.sha1(json.dumps(self._event_dict, sort_keys=True)
+                            .encode()).hexdigest()
 
     @property
     def _event_dict(self):
@@ -139,12 +385,15 @@ class Event:
                 'title': SOURCE_NAME,
                 'url': 'https://localhost:8000'
             },
-            'recurrence': [
-                f'RRULE:FREQ=WEEKLY;INTERVAL={self.interval};'
-                f'UNTIL={self.until.strftime("%Y%m%d")}'
-            ]
+            'recurrence': [self.rrule]
         }
 
+    @property
+    def rrule(self):
+        """Recurrence of the event in Calendar API event bodies"""
+        return (f'RRULE:FREQ=WEEKLY;INTERVAL={self.interval};'
+                f'UNTIL={self.until.strftime("%Y%m%d")}')
+
     def __hash__(self) -> int:
         return hash((self.uuid, self.summary, self.location, self.start_date_time,
                      self.end_date_time, self.interval, self.description, self.until))
@@ -169,121 +418,418 @@ class Event:
         return f'{self.uuid} {self.summary}'
 
 
+class EventBatch:
+    """Calendar event requests sent through the API batch endpoint
+
+    Requests are collected by create(), update() and delete() and sent by
+    execute() in batches of BATCH_SIZE, so a calendar update takes a few
+    round trips instead of one per event.
+    """
+
+    def __init__(self, service, calendar_id='primary'):
+        self.service = service
+        self.calendar_id = calendar_id
+        self.requests = list()  # (event, kind of request, request)
+        self.existing = list()  # created events that are already imported
+        self.pushed = list()  # events created or updated
+        self.deleted = list()
+        self.failed = list()  # (event, error)
+
+    def create(self, event: Event):
+        print(f'Creating event {event.summary}')
+        self.requests.append((event, 'create', event.api_create(
+            self.service, self.calendar_id)))
+
+    def update(self, event: Event):
+        print(f'Updating event {event.summary}')
+        self.requests.append((event, 'update', event.api_update(
+            self.service, self.calendar_id)))
+
+    def delete(self, event: Event):
+        print(f'deleting event {event.summary}')
+        self.requests.append((event, 'delete', event.api_delete(
+            self.service, self.calendar_id)))
+
+    def execute(self):
+        """Send collected requests
+
+        An event that can not be created because its iCalUID already
+        exists in the calendar is found by iCalUID and updated instead.
+
+        Returns:
+            List[Tuple[Event, Exception]]: events whose requests failed
+        """
+        requests, self.requests = self.requests, list()
+        self.send(requests)
+
+        if self.existing:
+            events, self.existing = self.existing, list()
+            self.send([(event, 'find',
+                        event.api_find(self.service, self.calendar_id))
+                       for event in events])
+            for event in events:
+                if event.id:
+                    self.update(event)
+            requests, self.requests = self.requests, list()
+            self.send(requests)
+
+        return self.failed
+
+    def send(self, requests):
+        """Send requests in batches
+
+        Requests rejected by rate limits are sent again after an
+        exponential backoff, up to QUOTA_RETRIES times.
+        """
+        for attempt in range(QUOTA_RETRIES + 1):
+            limited = list()  # requests rejected by rate limits
+            for first in range(0, len(requests), BATCH_SIZE):
+                chunk = requests[first:first + BATCH_SIZE]
+
+                def callback(request_id, response, exception, chunk=chunk):
+                    event, kind, _ = chunk[int(request_id)]
+                    if exception is None:
+                        self.succeeded(event, kind, response)
+                    elif (attempt < QUOTA_RETRIES and
+                          is_quota_error(exception)):
+                        limited.append(chunk[int(request_id)])
+                    elif not self.handled(event, kind, exception):
+                        print(f'Error!! {event.summary}: {exception}')
+                        self.failed.append((event, exception))
+
+                batch = self.service.new_batch_http_request(callback=callback)
+                for index, (_, _, request) in enumerate(chunk):
+                    batch.add(request, request_id=str(index))
+                throttle(len(chunk))
+                batch.execute()
+
+            if not limited:
+                return
+            delay = quota_backoff(attempt)
+            print(f'Rate limit exceeded, resending {len(limited)} requests '
+                  f'in {delay:.1f}s')
+            time.sleep(delay)
+            requests = limited
+
+    def succeeded(self, event: Event, kind, response):
+        if kind == 'delete':
+            self.deleted.append(event)
+        elif kind == 'find':
+            items = response.get('items', [])
+            if items:
+                event.id = items[0]['id']
+            else:
+                print(f'Error!! {event.summary}: event {event.uuid} not found')
+                self.failed.append((event, CalendarException(
+                    f'Event {event.uuid} was not found')))
+        else:
+            event.id = response.get('id', event.id)
+            self.pushed.append(event)
+
+    def handled(self, event: Event, kind, error):
+        """Whether a failed request does not mean the event failed"""
+        if not isinstance(error, HttpError):
+            return False
+        if kind == 'create' and error.reason == IDENTIFIER_EXISTS:
+            self.existing.append(event)
+            return True
+        if kind == 'delete' and error.resp.status in (404, 410):
+            self.deleted.append(event)  # the event is already deleted
+            return True
+        return False
+
+
+def active_lessons(lessons):
+    """Lessons of the semesters that are taking place"""
+    return lessons.filter(semester__startdate__lt=datetime.now().date(),
+                          semester__enddate__gt=datetime.now().date())
+
+
+def events_time_range():
+    """Events taking place in this range are synchronized with lessons"""
+    now = datetime.now(timezone.utc)
+    return now - timedelta(days=30), now + timedelta(days=14)
+
+
 class PersonBase:
 
     def __init__(self, user, mdl_user):
         self.user = user
         self.mdl_user = mdl_user
 
-    def get_calendar_events(self):
-        """Connect to user google calendar and return events created by this app
-
-        Returns:
-            Dict[int, Event]: Events from user calendar with defined source
-        """
+    def connect(self):
+        """Build Calendar API service with the user Google token"""
         if self.user:
             try:
-                social_token = SocialToken.objects.get(account__user=self.user)
+                social_token = (SocialToken.objects.select_related('app')
+                                .get(account__user=self.user))
             except SocialToken.DoesNotExist:
                 raise CalendarException(
                     f'Token was not found for Email {self.user.email}')
-
-            creds = Credentials(token=social_token.token,
-                                refresh_token=social_token.token_secret,
-                                client_id=social_token.app.client_id,
-                                client_secret=social_token.app.secret)
         else:
             raise CalendarException('User not authorisized')
 
-        self.service = build('calendar', 'v3', credentials=creds)
+        self.social_token = social_token
+        self.service = calendar_service(social_token)
 
-        now = (datetime.utcnow() - timedelta(days=30)).isoformat() + 'Z'
-        two_weeks_after = (datetime.utcnow() +
-                           timedelta(days=14)).isoformat() + 'Z'
+    def get_calendar_events(self):
+        """Connect to user google calendar and return events created by this app
+
+        Only events changed since the previous call are fetched, using the
+        sync token stored in CalendarSyncState. All events are fetched again
+        when there is no token or Google expired it.
 
+        Returns:
+            Dict[int, Event]: Events from user calendar with defined source
+            that take place from 30 days ago to 14 days later
+        """
+        self.connect()
+
+        state, _ = models.CalendarSyncState.objects.get_or_create(
+            user=self.user)
+        api_events = state.events if state.sync_token else dict()
         try:
-            events_result = self.service.events().list(calendarId='primary', timeMin=now,
-                                                       timeMax=two_weeks_after,
-                                                       singleEvents=False).execute()
+            try:
+                items, sync_token = self.list_events(state.sync_token)
+            except HttpError as error:
+                if error.resp.status != 410:  # sync token is not expired
+                    raise
+                api_events = dict()
+                items, sync_token = self.list_events()
         except RefreshError:
             raise CalendarException('Refresh Error try to login again')
 
-        api_events = events_result.get('items', [])
+        for api_event in items:
+            source = api_event.get('source')
+            if (api_event.get('status') == 'cancelled' or not source or
+                    source.get('title') != SOURCE_NAME):
+                api_events.pop(api_event['id'], None)  # deleted or not ours
+            else:
+                api_events[api_event['id']] = api_event
+        state.sync_token, state.events = sync_token or '', api_events
+        state.save()
+
+        time_min, time_max = events_time_range()
 
         events: Dict[int, Event] = dict()
-        for api_event in api_events:
-            source = api_event.get('source')
-            if not source or source.get('title') != SOURCE_NAME:
-                continue
+        for api_event in api_events.values():
             event_obj = Event.create_from_api_dict(api_event)
+            if (event_obj.start_date_time and
+                    event_obj.start_date_time >= time_max or
+                    event_obj.until and event_obj.until < time_min.date()):
+                continue  # does not take place in the time range
             events[event_obj.uuid] = event_obj
 
         return events
 
+    def list_events(self, sync_token=None):
+        """List all pages of calendar events
+
+        Args:
+            sync_token (str): nextSyncToken of a previous list, only events
+                changed since then are listed, deleted ones included
+
+        Returns:
+            Tuple[List[dict], str]: API event dicts and the next sync token
+        """
+        items, page_token = list(), None
+        while True:
+            kwargs = dict(calendarId='primary', singleEvents=False,
+                          maxResults=EVENTS_PAGE_SIZE, pageToken=page_token)
+            if sync_token:
+                kwargs['syncToken'] = sync_token
+            throttle()
+            # rate limit errors are retried with backoff by the client
+            events_result = (self.service.events().list(**kwargs)
+                             .execute(num_retries=QUOTA_RETRIES))
+            items += events_result.get('items', [])
+            page_token = events_result.get('nextPageToken')
+            if not page_token:
+                return items, events_result.get('nextSyncToken')
+
     def delete_calendar(self):
         try:
             events = self.get_calendar_events()
         except CalendarException as e:
             return str(e)
 
+        batch = EventBatch(self.service)
         for _, event in events.items():
-            event.api_delete(self.service)
+            batch.delete(event)
+        failed = batch.execute()
+        models.PushedEvent.objects.filter(
+            user=self.user,
+            lesson_id__in=[event.uuid for event in batch.deleted]).delete()
+        # lesson changes do not update the calendar any more
+        models.CalendarAudience.objects.filter(user=self.user).delete()
 
-        return f'deleted {len(events)} events'
+        return f'deleted {len(events) - len(failed)} events'
 
     def update_calendar(self):
-        try:
-            events = self.get_calendar_events()
-        except CalendarException as e:
-            return str(e)
+        """Make user calendar events equal to the lessons
 
-        checked, updated, created, deleted = list(), list(), list(), list()
-
-        lessons = self.search_lessons()
-        lessons = lessons.filter(semester__startdate__lt=datetime.now().date(),
-                                 semester__enddate__gt=datetime.now().date())
-        if not lessons:
+        Lessons are compared with the events stored in PushedEvent when
+        they were sent, so an update without lesson changes makes no
+        Google API requests. Once in RECONCILE_INTERVAL lessons are
+        compared with the calendar events instead, which also restores
+        events changed or deleted in the calendar.
+        """
+        if not self.user:
+            return 'User not authorisized'
+
+        # lessons imported later, or a failed update, update the calendar
+        self.save_audience()
+        lessons = active_lessons(self.search_lessons())
+        stored = {pushed.lesson_id: pushed for pushed in
+                  models.PushedEvent.objects.filter(user=self.user)}
+        if not lessons and not stored:
             return "No active lessons found for user"
+
+        state, _ = models.CalendarSyncState.objects.get_or_create(
+            user=self.user)
+        reconcile = (state.reconciled_at is None or
+                     state.reconciled_at <
+                     datetime.now(timezone.utc) - RECONCILE_INTERVAL)
+        if reconcile:
+            try:
+                events = self.get_calendar_events()
+            except CalendarException as e:
+                return str(e)
+        else:
+            time_min, _ = events_time_range()
+            events = {lesson_id: Event.create_from_pushed(pushed)
+                      for lesson_id, pushed in stored.items()
+                      if pushed.until >= time_min.date()}
+
+        checked, updated, created = list(), list(), list()
+        lesson_ids = set()
         for lesson in lessons:
+            if lesson.id in lesson_ids:
+                continue  # found by several groups
+            lesson_ids.add(lesson.id)
             lesson_event = Event.create_from_lesson(lesson)
             lesson_event.description = self.build_description(lesson)
             if lesson.id in events:
-                if events[lesson.id] != lesson_event:  # lesson info changed
-                    # events created from model doesn't have id
-                    lesson_event.id = events[lesson.id].id
-                    lesson_event.api_update(self.service)
-                    updated.append(lesson.id)
+                if reconcile:
+                    changed = events[lesson.id] != lesson_event
                 else:
-                    checked.append(lesson.id)
+                    changed = (stored[lesson.id].fingerprint !=
+                               lesson_event.fingerprint)
+                # events created from model doesn't have id
+                lesson_event.id = events[lesson.id].id
+                if changed:  # lesson info changed
+                    updated.append(lesson_event)
+                else:
+                    checked.append(lesson_event)
             else:
-                events[lesson.id] = lesson_event
-                lesson_event.api_create(self.service)
-                created.append(lesson.id)
-
-        for id, event in events.items():
-            if id in checked or id in updated or id in created:
-                continue
-
-            event.api_delete(self.service)
-            deleted.append(id)
+                created.append(lesson_event)
+        deleted = [event for id, event in events.items()
+                   if id not in lesson_ids]
+
+        failed = list()
+        batch = None
+        if updated or created or deleted:
+            if not reconcile:
+                try:
+                    self.connect()
+                except CalendarException as e:
+                    return str(e)
+            batch = EventBatch(self.service)
+            for event in created:
+                batch.create(event)
+            for event in updated:
+                batch.update(event)
+            for event in deleted:
+                batch.delete(event)
+            failed = batch.execute()
+
+        self.save_pushed_events(stored, checked, batch, reconcile)
+        if reconcile:
+            state.reconciled_at = datetime.now(timezone.utc)
+            state.save(update_fields=['reconciled_at'])
 
         result = f'checked: {len(checked)}, updated: {len(updated)}, created: '\
                  f'{len(created)}, deleted: {len(deleted)}'
+        if failed:
+            result += f', failed: {len(failed)}'
         return result
 
+    def save_pushed_events(self, stored, checked, batch, reconcile):
+        """Store the events the calendar has after update_calendar
+
+        Args:
+            stored (Dict[uuid.UUID, models.PushedEvent]): stored before
+            checked (Iterable[Event]): lesson events equal to the calendar
+            batch (EventBatch): sent requests, None if nothing was sent
+            reconcile (bool): the calendar events were listed, events not
+                found there are removed
+        """
+        rows = dict()  # lesson id -> (event id, fingerprint, until)
+        if reconcile:
+            rows.update((event.uuid, (event.id, event.fingerprint,
+                                      event.until))
+                        for event in checked)
+            if batch:  # failed requests are repeated by the next update
+                rows.update((event.uuid, (event.id, '', event.until))
+                            for event, _ in batch.failed if event.id)
+        else:
+            rows.update((lesson_id, (pushed.event_id, pushed.fingerprint,
+                                     pushed.until))
+                        for lesson_id, pushed in stored.items())
+        if batch:
+            rows.update((event.uuid, (event.id, event.fingerprint,
+                                      event.until))
+                        for event in batch.pushed)
+            for event in batch.deleted:
+                rows.pop(event.uuid, None)
+
+        changed = [lesson_id for lesson_id, row in rows.items()
+                   if lesson_id not in stored or
+                   (stored[lesson_id].event_id, stored[lesson_id].fingerprint,
+                    stored[lesson_id].until) != row]
+        removed = [lesson_id for lesson_id in stored if lesson_id not in rows]
+        if not changed and not removed:
+            return
+
+        with transaction.atomic():
+            models.PushedEvent.objects.filter(
+                user=self.user, lesson_id__in=changed + removed).delete()
+            models.PushedEvent.objects.bulk_create(
+                models.PushedEvent(user=self.user, lesson_id=lesson_id,
+                                   event_id=event_id, fingerprint=fingerprint,
+                                   until=until)
+                for lesson_id, (event_id, fingerprint, until) in
+                ((lesson_id, rows[lesson_id]) for lesson_id in changed))
+
+    def save_audience(self):
+        """Store groups and courses whose lesson changes update the calendar"""
+        groups, teacher = self.audience_groups()
+        audience = [models.CalendarAudience(user=self.user, group=group)
+                    for group in groups]
+        audience += [models.CalendarAudience(user=self.user,
+                                             course_id=course_id,
+                                             teacher=teacher)
+                     for course_id in set(self.enrolled_course_ids)]
+        with transaction.atomic():
+            models.CalendarAudience.objects.filter(user=self.user).delete()
+            models.CalendarAudience.objects.bulk_create(audience)
+
     def build_description(self, lesson: models.Lesson):
         return f'<a href="{lesson.meetingurl}">Meeting Url</a>\n'\
                f'type: {lesson.get_type_display()}'
 
     @property
     def enrolled_course_ids(self):
-        return ([id for id in (MdlUserEnrolments.objects
-                               .filter(userid=self.mdl_user, status=0)
-                               .values_list('enrolid__courseid_id', flat=True))])
+        return ([id for id in (models.MoodleEnrolment.objects
+                               .filter(user_id=self.mdl_user.pk, status=0)
+                               .values_list('course_id', flat=True))])
 
 
 class Teacher(PersonBase):
 
+    def audience_groups(self):
+        return [], True
+
     def search_lessons(self):
         return (models.Lesson.objects.prefetch_related('groups')
                 .select_related('subject', 'lesson_number', 'semester')
@@ -294,39 +840,345 @@ class Teacher(PersonBase):
         return f'{description}\ngroups: {[group.name for group in lesson.groups.all()]}'
 
 
-class Student(PersonBase):
+class CourseTeachersDescription:
+    """Adds the teachers of the lesson course to the event description"""
+
+    def build_description(self, lesson: models.Lesson) -> str:
+        if not hasattr(self, 'course_teachers'):
+            self.course_teachers = course_teachers.get()
+
+        description = super().build_description(lesson)
+        return f'{description}\nteachers: {self.course_teachers.get(lesson.subject.course_id, [])}'
+
+
+class Student(CourseTeachersDescription, PersonBase):
+    # group name -> course ids of the group calendar the user has, lessons
+    # of these courses are not copied
+    subscribed_courses = dict()
+
+    @property
+    def cohorts_names(self):
+        return list(models.MoodleCohortMember.objects
+                    .filter(user_id=self.mdl_user.pk)
+                    .values_list('cohort_name', flat=True))
+
+    def audience_groups(self):
+        return self.cohorts_names, False
 
     def search_lessons(self):
-        cohorts_names = list(MdlCohortMembers.objects.filter(userid=self.mdl_user)
-                             .values_list('cohortid__name', flat=True))
+        lessons = (models.Lesson.objects
+                   .select_related('subject', 'lesson_number', 'semester')
+                   .filter(groups__name__in=self.cohorts_names,
+                           subject__course_id__in=self.enrolled_course_ids))
+        for group, course_ids in self.subscribed_courses.items():
+            lessons = lessons.exclude(groups__name=group,
+                                      subject__course_id__in=course_ids)
+        return lessons
 
+    def update_calendar(self):
+        """Subscribe to group calendars and copy the other lessons
+
+        Lessons of a group are copied to the user calendar when group
+        calendars are not configured or the subscription failed, and so
+        are lessons of courses not all group members are enrolled in.
+        """
+        if GOOGLE_SERVICE_ACCOUNT_FILE and self.user:
+            self.subscribed_courses = self.subscribe_group_calendars()
+        return super().update_calendar()
+
+    def delete_calendar(self):
+        result = super().delete_calendar()
+        for member in (models.GroupCalendarMember.objects
+                       .filter(user=self.user)
+                       .select_related('group_calendar')):
+            self.unsubscribe(member)
+        return result
+
+    def subscribe_group_calendars(self):
+        """Subscribe the user to calendars of its groups
+
+        Calendars of groups the user is not in any more are unsubscribed.
+
+        Returns:
+            Dict[str, List[int]]: course ids of the calendars the user has
+            by group name
+        """
+        groups = set(models.Group.objects.filter(name__in=self.cohorts_names)
+                     .values_list('name', flat=True))
+        members = {member.group_calendar.group_id: member for member in
+                   models.GroupCalendarMember.objects.filter(user=self.user)
+                   .select_related('group_calendar')}
+
+        subscribed = dict()
+        for group in groups:
+            member = members.get(group)
+            if member and not member.refused_token:
+                subscribed[group] = member.group_calendar.course_ids
+                continue
+            try:
+                if member and member.refused_token == self.token_hash():
+                    continue  # until the user logs in again
+                calendar = group_calendar(group)
+                self.subscribe(calendar)
+            except (HttpError, RefreshError, CalendarException) as e:
+                print(f'Error!! {self.user} {group} calendar: {e}')
+                continue
+            subscribed[group] = calendar.course_ids
+
+        for group, member in members.items():
+            if group not in groups:
+                self.unsubscribe(member)
+        return subscribed
+
+    def token_hash(self):
+        """Identifies the Google login of the user"""
+        if getattr(self, 'service', None) is None:
+            self.connect()
+        token = self.social_token.token_secret or self.social_token.token
+        return hashlib.sha1(token.encode()).hexdigest()
+
+    def subscribe(self, calendar: models.GroupCalendar):
+        """Share the calendar with the user and add it to the user list
+
+        The calendar is not shared when it can not be added to the list.
+        Tokens of users who logged in before the calendar list scope was
+        requested are refused, and the calendar is not tried again with
+        the refused token.
+        """
+        if getattr(self, 'service', None) is None:
+            self.connect()
+        throttle(2)
+        acl = service_account_service().acl()
+        rule = acl.insert(
+            calendarId=calendar.calendar_id, sendNotifications=False,
+            body={'role': 'reader',
+                  'scope': {'type': 'user', 'value': self.user.email}}
+        ).execute(num_retries=QUOTA_RETRIES)
+        try:
+            self.service.calendarList().insert(
+                body={'id': calendar.calendar_id}
+            ).execute(num_retries=QUOTA_RETRIES)
+        except (HttpError, RefreshError) as error:
+            rule_id = ''
+            try:
+                acl.delete(calendarId=calendar.calendar_id,
+                           ruleId=rule['id']).execute(num_retries=QUOTA_RETRIES)
+            except HttpError as e:
+                print(f'Error!! {self.user} {calendar} rule: {e}')
+                rule_id = rule['id']  # deleted by unsubscribe
+            if isinstance(error, RefreshError) or (
+                    error.resp.status in (401, 403) and
+                    not is_quota_error(error)):
+                models.GroupCalendarMember.objects.update_or_create(
+                    group_calendar=calendar, user=self.user,
+                    defaults=dict(rule_id=rule_id,
+                                  refused_token=self.token_hash()))
+            raise
+        models.GroupCalendarMember.objects.update_or_create(
+            group_calendar=calendar, user=self.user,
+            defaults=dict(rule_id=rule['id'], refused_token=''))
+
+    def unsubscribe(self, member: models.GroupCalendarMember):
+        calendar_id = member.group_calendar.calendar_id
+        try:
+            if getattr(self, 'service', None) is None:
+                self.connect()
+            throttle(2)
+            requests = []
+            if not member.refused_token:
+                requests.append(
+                    self.service.calendarList().delete(calendarId=calendar_id))
+            if member.rule_id:
+                requests.append(service_account_service().acl().delete(
+                    calendarId=calendar_id, ruleId=member.rule_id))
+            for request in requests:
+                try:
+                    request.execute(num_retries=QUOTA_RETRIES)
+                except HttpError as error:
+                    if error.resp.status not in (404, 410):  # not deleted
+                        raise
+        except (HttpError, RefreshError, CalendarException) as e:
+            print(f'Error!! {self.user} {member.group_calendar}: {e}')
+            return
+        member.delete()
+
+
+class GroupSchedule(CourseTeachersDescription, PersonBase):
+    """Lessons of a group, for a group calendar or feed without a user"""
+
+    def __init__(self, group: models.Group):
+        super().__init__(None, None)
+        self.group = group
+
+    def audience_groups(self):
+        return [self.group.name], False
+
+    @property
+    def enrolled_course_ids(self):
+        return []
+
+    def search_lessons(self):
         return (models.Lesson.objects
                 .select_related('subject', 'lesson_number', 'semester')
-                .filter(groups__name__in=cohorts_names,
-                        subject__course_id__in=self.enrolled_course_ids))
-
-    def build_description(self, lesson: models.Lesson) -> str:
-        if not hasattr(self, 'course_teachers') or not hasattr(self, 'user_names'):
-            course_users = defaultdict(set)
-            self.user_names = dict()
-            for course_name, user_id, firstname, lastname in (
-                MdlUserEnrolments.objects
-                .filter(enrolid__courseid__in=self.enrolled_course_ids, status=0)
-                .values_list('enrolid__courseid__shortname', 'userid_id',
-                             'userid__firstname', 'userid__lastname')
-            ):
-                course_users[course_name].add(user_id)
-                self.user_names[user_id] = f'{firstname} {lastname}'
-
-            teacher_ids = set(MdlRoleAssignments.objects
-                              .filter(userid__in=set().union(*course_users.values()),
-                                      roleid__shortname='editingteacher')
-                              .values_list('userid_id', flat=True)
-                              .distinct())
-
-            self.course_teachers = dict()
-            for course_name, user_ids in course_users.items():
-                self.course_teachers[course_name] = user_ids & teacher_ids
+                .filter(groups=self.group))
 
-        description = super().build_description(lesson)
-        return f'{description}\nteachers: {[self.user_names[name] for name in self.course_teachers.get(lesson.subject.title, [])]}'
+    @property
+    def common_course_ids(self):
+        """Courses all Moodle members of the group are enrolled in"""
+        members = (models.MoodleCohortMember.objects
+                   .filter(cohort_name=self.group.name)
+                   .values_list('user_id', flat=True).distinct())
+        count = members.count()
+        if not count:
+            return []
+        return sorted(models.MoodleEnrolment.objects
+                      .filter(user_id__in=members, status=0)
+                      .values('course_id')
+                      .annotate(users=Count('user_id', distinct=True))
+                      .filter(users=count)
+                      .values_list('course_id', flat=True))
+
+
+def group_calendar(group) -> models.GroupCalendar:
+    """Calendar of the group, created by the service account if missing
+
+    A created calendar gets its lessons by sync_group_calendar.
+    """
+    with transaction.atomic():
+        calendar, _ = (models.GroupCalendar.objects.select_for_update()
+                       .get_or_create(group_id=group))
+        if not calendar.calendar_id:
+            throttle()
+            calendar.calendar_id = service_account_service().calendars().insert(
+                body={'summary': f'{group} {SOURCE_NAME}',
+                      'timeZone': 'Europe/Kyiv'}
+            ).execute(num_retries=QUOTA_RETRIES)['id']
+            calendar.outdated = True
+            calendar.save()
+    return calendar
+
+
+def sync_group_calendar(calendar: models.GroupCalendar):
+    """Make group calendar events equal to the group lessons
+
+    The calendar has lessons of the courses all group members are enrolled
+    in, members are updated when these courses change, to copy the other
+    lessons. Nobody else changes the calendar, so lessons are compared with
+    the events stored in GroupCalendarEvent only.
+    """
+    schedule = GroupSchedule(calendar.group)
+    course_ids = schedule.common_course_ids
+    stored = {event.lesson_id: event for event in calendar.events.all()}
+    batch = EventBatch(service_account_service(), calendar.calendar_id)
+    lesson_ids = set()
+    for lesson in active_lessons(schedule.search_lessons().filter(
+            subject__course_id__in=course_ids)):
+        if lesson.id in lesson_ids:
+            continue
+        lesson_ids.add(lesson.id)
+        event = Event.create_from_lesson(lesson)
+        event.description = schedule.build_description(lesson)
+        if lesson.id not in stored:
+            batch.create(event)
+        elif stored[lesson.id].fingerprint != event.fingerprint:
+            event.id = stored[lesson.id].event_id
+            batch.update(event)
+    for lesson_id, pushed in stored.items():
+        if lesson_id not in lesson_ids:
+            batch.delete(Event.create_from_pushed(pushed))
+    failed = batch.execute()
+
+    # events deleted from the calendar are created by the next sync
+    missing = [event.uuid for event, error in failed
+               if isinstance(error, HttpError) and
+               error.resp.status in (404, 410)]
+    changed = [event.uuid for event in batch.pushed + batch.deleted]
+    with transaction.atomic():
+        calendar.events.filter(lesson_id__in=changed + missing).delete()
+        models.GroupCalendarEvent.objects.bulk_create(
+            models.GroupCalendarEvent(group_calendar=calendar,
+                                      lesson_id=event.uuid, event_id=event.id,
+                                      fingerprint=event.fingerprint,
+                                      until=event.until)
+            for event in batch.pushed)
+        calendar.synced_at = datetime.now(timezone.utc)
+        calendar.save(update_fields=['synced_at'])
+        if course_ids != calendar.course_ids:
+            calendar.course_ids = course_ids
+            calendar.save(update_fields=['course_ids'])
+            models.CalendarSyncJob.enqueue_updates(
+                list(calendar.members.filter(refused_token='')
+                     .values_list('user_id', flat=True)))
+        if failed:  # failed requests are repeated by the next sync
+            calendar.sync_failed()
+        elif calendar.failures:
+            calendar.failures, calendar.retry_at = 0, None
+            calendar.save(update_fields=['failures', 'retry_at'])
+
+    result = f'pushed: {len(batch.pushed)}, deleted: {len(batch.deleted)}'
+    if failed:
+        result += f', failed: {len(failed)}'
+    return result
+
+
+def fan_out_lesson_changes(limit=FAN_OUT_CHANGES):
+    """Enqueue calendar updates of users whose lessons changed
+
+    Users are found by CalendarAudience: students having a group of the
+    lesson and enrolled in its course, teachers of the course. Processed
+    LessonChange rows are deleted.
+
+    Returns:
+        Tuple[int, int]: numbers of processed changes and enqueued jobs
+    """
+    with transaction.atomic():
+        changes = list(models.LessonChange.objects
+                       .select_for_update(skip_locked=True)
+                       .order_by('pk')[:limit])
+        if not changes:
+            return 0, 0
+
+        groups = {group for change in changes for group in change.groups}
+        course_ids = {change.course_id for change in changes
+                      if change.course_id is not None}
+        group_users = defaultdict(set)
+        course_students, course_teachers = defaultdict(set), defaultdict(set)
+        for user_id, group, course_id, teacher in (
+            models.CalendarAudience.objects
+            .filter(Q(group__in=groups) | Q(course_id__in=course_ids))
+            .values_list('user_id', 'group', 'course_id', 'teacher')
+        ):
+            if group:
+                group_users[group].add(user_id)
+            elif teacher:
+                course_teachers[course_id].add(user_id)
+            else:
+                course_students[course_id].add(user_id)
+
+        user_ids = set()
+        for change in changes:
+            students = set().union(*(group_users[group]
+                                     for group in change.groups))
+            user_ids |= course_teachers[change.course_id]
+            user_ids |= students & course_students[change.course_id]
+
+        jobs = models.CalendarSyncJob.enqueue_updates(user_ids)
+        models.GroupCalendar.objects.filter(group_id__in=groups).update(
+            outdated=True)
+        models.LessonChange.objects.filter(
+            pk__in=[change.pk for change in changes]).delete()
+    return len(changes), jobs
+
+
+def create_person(user, mdl_user: models.MoodleUser) -> PersonBase:
+    """Teacher if the Moodle user has more teacher than student roles"""
+    role_assignments = (
+        models.MoodleRoleAssignment.objects.filter(user_id=mdl_user.pk)
+        .aggregate(teaches=Count('pk', filter=Q(role='editingteacher')),
+                   studying=Count('pk', filter=Q(role='student')))
+    )
+
+    if role_assignments['teaches'] > role_assignments['studying']:
+        return Teacher(user, mdl_user)
+    else:
+        return Student(user, mdl_user)
@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta, timezone
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.utils import OperationalError
+
+from main.g_calendar import (create_person, fan_out_lesson_changes,
+                             sync_group_calendar)
+from main.models import CalendarSyncJob, GroupCalendar, MoodleUser
+from schedule_nubip.settings import GOOGLE_SERVICE_ACCOUNT_FILE
+
+SLEEP_SECONDS = 2  # users wait for the result on the page
+JOBS_PER_CLAIM = 1  # a job is taken when it starts, so its lease does too
+GROUP_CALENDARS_PER_CLAIM = 10
+KEEP_FINISHED = timedelta(days=7)
+
+
+class Command(BaseCommand):
+    help = 'Run Google Calendar updates requested by users'
+
+    def handle(self, *args, **kwargs):
+        # process new jobs in infinite loop, several commands may run
+        while True:
+            try:
+                self.fan_out()
+                if GOOGLE_SERVICE_ACCOUNT_FILE:
+                    self.sync_group_calendars()
+                jobs = CalendarSyncJob.claim(JOBS_PER_CLAIM)
+            except OperationalError:
+                jobs = []
+            for job in jobs:
+                try:
+                    self.process_job(job)
+                except OperationalError:
+                    break
+
+            if not jobs:  # check again at once while jobs are waiting
+                self.delete_finished()
+                time.sleep(SLEEP_SECONDS)
+
+    def process_job(self, job: CalendarSyncJob):
+        started = time.perf_counter()
+        try:
+            message = self.sync_calendar(job)
+        except OperationalError:
+            raise  # the job is taken again after its lease
+        except Exception as e:
+            print(f'Error!! {job}: {e}')
+            job.finish(CalendarSyncJob.Status.FAILED,
+                       'Calendar update failed, please try again later')
+            return
+
+        job.finish(CalendarSyncJob.Status.DONE, message)
+        self.stdout.write(f'{job}: {message} '
+                          f'in {time.perf_counter() - started:.1f}s')
+
+    def fan_out(self):
+        """Enqueue updates of calendars with changed lessons"""
+        changes, jobs = fan_out_lesson_changes()
+        if changes:
+            self.stdout.write(f'{changes} lesson changes: '
+                              f'{jobs} calendar updates enqueued')
+
+    def sync_group_calendars(self):
+        """Sync group calendars whose lessons changed"""
+        for calendar in GroupCalendar.claim_outdated(
+                GROUP_CALENDARS_PER_CLAIM):
+            started = time.perf_counter()
+            try:
+                message = sync_group_calendar(calendar)
+            except OperationalError:
+                raise
+            except Exception as e:
+                print(f'Error!! {calendar}: {e}')
+                calendar.sync_failed()
+                continue
+            self.stdout.write(f'{calendar}: {message} '
+                              f'in {time.perf_counter() - started:.1f}s')
+
+    @staticmethod
+    def sync_calendar(job: CalendarSyncJob):
+        # search user email in db
+        try:
+            mdl_user = MoodleUser.objects.get(email=job.email)
+        except MoodleUser.DoesNotExist:
+            return f'Email {job.email} was not found in database, please ' \
+                   f'use another email or contact administrator'
+
+        person = create_person(job.user, mdl_user)
+        # create google calendar events for user
+        if job.action == CalendarSyncJob.Action.DELETE:
+            return person.delete_calendar()
+        return person.update_calendar()
+
+    @staticmethod
+    def delete_finished():
+        CalendarSyncJob.objects.filter(
+            finished_at__lt=datetime.now(timezone.utc) - KEEP_FINISHED
+        ).delete()
@@ -0,0 +1,89 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import time
+
+from django.contrib.auth import get_user_model
+from django.db import connections
+from django.db.models import Count
+
+from main import g_calendar
+from main.management.commands.calendar_sync import Command as SyncCommand
+from main.models import CalendarSyncJob, CalendarSyncRun
+
+WAIT_SECONDS = 10  # for jobs that can not be taken yet
+
+
+class Command(SyncCommand):
+    help = 'Update Google calendars of all users having a Google token'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--threads', type=int, default=8,
+            help='number of calendars updated at the same time')
+        parser.add_argument(
+            '--rate', type=float, default=50,
+            help='Calendar API requests per second of all threads')
+        parser.add_argument(
+            '--restart', action='store_true',
+            help='start a new run instead of resuming an interrupted one')
+
+    def handle(self, *args, **kwargs):
+        threads = kwargs['threads']
+        g_calendar.rate_limiter = g_calendar.RateLimiter(kwargs['rate'])
+
+        run = (CalendarSyncRun.objects.filter(finished_at=None)
+               .order_by('-pk').first())
+        if run and kwargs['restart']:
+            run.finish()  # its unfinished jobs join the new run
+            run = None
+        if run:
+            self.stdout.write(f'{run}: resumed, {self.progress(run)}')
+        else:
+            run = CalendarSyncRun.objects.create()
+            users = (get_user_model().objects
+                     .filter(socialaccount__socialtoken__isnull=False)
+                     .distinct().values_list('pk', 'email'))
+            self.stdout.write(f'{run}: {run.add_jobs(users)} calendars')
+
+        started = time.perf_counter()
+        self.process_run(run, threads)
+        run.finish()
+        self.stdout.write(f'{run}: {self.progress(run)} '
+                          f'in {time.perf_counter() - started:.1f}s')
+
+    def process_run(self, run: CalendarSyncRun, threads):
+        """Process jobs of the run in a thread pool until none is left
+
+        Jobs are claimed as threads get free, a job interrupted by a
+        database error is taken again when its lease expires. Jobs that
+        can not be taken yet, like jobs of an interrupted process or of
+        users updated by calendar_sync, are waited for.
+        """
+        unfinished = run.jobs.filter(status__in=[
+            CalendarSyncJob.Status.NEW, CalendarSyncJob.Status.IN_PROGRESS])
+        with ThreadPoolExecutor(threads) as pool:
+            running = set()
+            while True:
+                if len(running) < threads:
+                    jobs = CalendarSyncJob.claim(threads - len(running), run)
+                    running |= {pool.submit(self.process_run_job, job)
+                                for job in jobs}
+                if not running:
+                    if not unfinished.exists():
+                        return
+                    time.sleep(WAIT_SECONDS)
+                    continue
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+
+    def process_run_job(self, job: CalendarSyncJob):
+        try:
+            self.process_job(job)
+        finally:
+            connections.close_all()  # of this thread
+
+    @staticmethod
+    def progress(run: CalendarSyncRun):
+        counts = dict(run.jobs.values_list('status').annotate(Count('pk')))
+        return ', '.join(f'{status.label.lower()} {counts.get(status, 0)}'
+                         for status in CalendarSyncJob.Status)
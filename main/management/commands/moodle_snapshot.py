@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.utils import OperationalError
+
+from main.models import GroupCalendar
+from main.moodle_snapshot import SNAPSHOTS, refresh_snapshot
+
+SLEEP_SECONDS = 5 * 60
+
+
+class Command(BaseCommand):
+    help = 'Copy Moodle users, enrolments, cohorts and roles read by ' \
+           'calendar updates to the schedule database'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once', action='store_true',
+            help='refresh once and exit instead of refreshing every '
+                 f'{SLEEP_SECONDS // 60} minutes')
+
+    def handle(self, *args, **kwargs):
+        while True:
+            try:
+                self.refresh()
+            except OperationalError as e:
+                print(f'Error!! Moodle snapshot: {e}')
+            if kwargs['once']:
+                return
+            time.sleep(SLEEP_SECONDS)
+
+    def refresh(self):
+        changed = False
+        for snapshot in SNAPSHOTS:
+            started = time.perf_counter()
+            copied, deleted = refresh_snapshot(snapshot)
+            changed |= bool(copied or deleted)
+            self.stdout.write(f'{snapshot.model._meta.db_table}: '
+                              f'copied {copied}, deleted {deleted} rows '
+                              f'in {time.perf_counter() - started:.1f}s')
+        if changed:
+            # courses of group calendars depend on members and enrolments
+            GroupCalendar.objects.update(outdated=True)
@@ -1,31 +1,197 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from multiprocessing import get_context
+import cProfile
+import os
+
 from django.core.management.base import BaseCommand
+from django.db import connections
 from django.db.utils import OperationalError
-from main.schedule_file_parser import ScheduleFileParser
-from main.models import ScheduleFile, Lesson
+from main.schedule_file_parser import (CourseMatcher, ImportStats,
+                                       ScheduleSheet, ScheduleFileParser,
+                                       file_hash, load_cached_schedule,
+                                       match_courses, save_cached_schedule)
+from main.models import ScheduleFile
 import time
 
 SLEEP_SECONDS = 30
 
+worker_course_matcher = None  # CourseMatcher of a worker process
+
+
+def init_worker():
+    global worker_course_matcher
+    worker_course_matcher = CourseMatcher()
+
+
+def read_file(path, content_hash, streaming):
+    """Read a schedule file and match its subjects in a worker process
+
+    Returns:
+        Tuple[dict, Dict[str, CourseMatch], ImportStats]:
+        ScheduleSheet.read_schedule() result, course matches by subject
+        name and stats of reading and matching
+    """
+    stats = ImportStats()
+    schedule = load_cached_schedule(content_hash)
+    if schedule is None:
+        schedule = ScheduleSheet(path, streaming, stats).read_schedule()
+        save_cached_schedule(content_hash, schedule)
+
+    matches = match_courses(schedule, worker_course_matcher, stats)
+    return schedule, matches, stats
+
 
 class Command(BaseCommand):
+    profile_dir = None  # --profile
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--incremental', action='store_true',
+            help='write only lessons that changed since the last import '
+                 'instead of deleting and recreating faculty lessons')
+        parser.add_argument(
+            '--streaming', action='store_true',
+            help='read sheets in openpyxl read-only mode, uses less memory '
+                 'on large workbooks')
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='number of processes reading files in parallel, columns '
+                 'of a single file are split between them')
+        parser.add_argument(
+            '--profile', metavar='DIR',
+            help='write cProfile stats of every file import to DIR, with '
+                 'several workers only the writing process is profiled')
 
     def handle(self, *args, **kwargs):
-        # process new files in infinite loop
+        incremental = kwargs['incremental']
+        streaming = kwargs['streaming']
+        workers = kwargs['workers']
+        self.profile_dir = kwargs['profile']
+        # process new files in infinite loop, several commands may run
         while True:
-            new_files = ScheduleFile.objects.filter(
-                status=ScheduleFile.Status.NEW)
+            try:
+                new_files = ScheduleFile.claim(workers)
+            except OperationalError:
+                new_files = []
+            if workers > 1 and len(new_files) > 1:
+                self.process_files(new_files, incremental, streaming, workers)
+            else:
+                for new_file in new_files:
+                    try:
+                        self.process_file(new_file, incremental, streaming,
+                                          workers)
+                    except OperationalError:
+                        break
+
+            if not new_files:  # check again at once while files are waiting
+                time.sleep(SLEEP_SECONDS)
+
+    def process_file(self, new_file: ScheduleFile, incremental, streaming,
+                     workers=1):
+        started = time.perf_counter()
+        content_hash = self.changed_content_hash(new_file)
+        if content_hash is None:
+            return
+
+        with self.profile(new_file):
+            stats = ImportStats()
+            # the same file content may have been parsed before
+            schedule = load_cached_schedule(content_hash)
+            parser = ScheduleFileParser(
+                new_file.file, new_file.faculty, new_file.semester, schedule,
+                streaming, workers=workers, stats=stats)
+            if schedule is None:
+                save_cached_schedule(content_hash, parser.schedule)
+            self.write_file(new_file, content_hash, parser, incremental,
+                            started)
+
+    def process_files(self, new_files, incremental, streaming, workers):
+        """Read files in a process pool and write them one by one
+
+        Workers only read files and match subjects to Moodle courses.
+        Lessons are written by this process, so lessons of a faculty and
+        semester are never written by two processes at the same time.
+        """
+        connections.close_all()  # forked workers open their own connections
+        pool = ProcessPoolExecutor(workers, mp_context=get_context('fork'),
+                                   initializer=init_worker)
+        try:
+            futures = dict()
             for new_file in new_files:
+                started = time.perf_counter()
+                content_hash = self.changed_content_hash(new_file)
+                if content_hash is None:
+                    continue
+                future = pool.submit(read_file, new_file.file.path,
+                                     content_hash, streaming)
+                futures[future] = (new_file, content_hash, started)
+
+            for future in as_completed(futures):
+                new_file, content_hash, started = futures[future]
+                schedule, matches, stats = future.result()
+                self.stdout.write(f'{new_file}: read, {stats}')
+
+                course_matcher = CourseMatcher()
+                course_matcher.matches.update(matches)
                 try:
-                    lessons = Lesson.objects.filter(
-                        groups__specialty__faculty=new_file.faculty,
-                        semester=new_file.semester)
-                    lessons.delete()
-                    parser = ScheduleFileParser(
-                        new_file.file, new_file.faculty, new_file.semester)
-                    parser.serialize_to_db()
-                    new_file.status = ScheduleFile.Status.PROCESSED
-                    new_file.save()
+                    with self.profile(new_file):
+                        parser = ScheduleFileParser(
+                            None, new_file.faculty, new_file.semester,
+                            schedule, course_matcher=course_matcher,
+                            stats=stats)
+                        self.write_file(new_file, content_hash, parser,
+                                        incremental, started)
                 except OperationalError:
                     break
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+    def changed_content_hash(self, new_file: ScheduleFile):
+        """Return hash of the file content, None if it is already imported"""
+        content_hash = file_hash(new_file.file)
+        if content_hash != new_file.content_hash:
+            return content_hash
+
+        self.stdout.write(f'{new_file}: not changed since last import')
+        new_file.status = ScheduleFile.Status.PROCESSED
+        new_file.save()
+        return None
+
+    @contextmanager
+    def profile(self, new_file: ScheduleFile):
+        """Profile the block if --profile is given"""
+        if not self.profile_dir:
+            yield
+            return
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            os.makedirs(self.profile_dir, exist_ok=True)
+            path = os.path.join(self.profile_dir,
+                                f'schedule_file_{new_file.pk}.prof')
+            profile.dump_stats(path)
+            self.stdout.write(f'{new_file}: profile written to {path}')
 
-            time.sleep(SLEEP_SECONDS)
+    def write_file(self, new_file: ScheduleFile, content_hash,
+                   parser: ScheduleFileParser, incremental, started):
+        """Write parsed lessons and report wall time since started"""
+        # without --incremental the faculty lessons are replaced
+        result = parser.serialize_to_db(incremental,
+                                        replace=not incremental)
+        self.stdout.write(
+            f'{new_file}: created {result["created"]}, '
+            f'updated {result["updated"]}, '
+            f'deleted {result["deleted"]} lessons, '
+            f'added {result["groups"]}, '
+            f'removed {result["removed_groups"]} lesson groups '
+            f'in {time.perf_counter() - started:.1f}s')
+        self.stdout.write(f'{new_file}: {parser.stats}')
+        new_file.status = ScheduleFile.Status.PROCESSED
+        new_file.content_hash = content_hash
+        new_file.import_stats = parser.stats.as_dict()
+        new_file.save()
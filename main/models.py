@@ -1,11 +1,42 @@
+import secrets
 import uuid
-from django.db import models
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import models, transaction
+from django.db.models import Exists, OuterRef
 
 from datetime import datetime, date, timezone, timedelta
 
 YEAR_CHOICES = [(r, r) for r in range(2015, date.today().year+1)]
 
 
+def claim_rows(rows, limit, **values):
+    """Take up to limit rows for a worker, setting values on them
+
+    Rows locked by another worker are skipped, so concurrent workers never
+    take the same row.
+
+    Args:
+        rows (QuerySet): rows that may be taken, in the order of taking
+        values: field values of the taken rows, e.g. their new status
+    """
+    with transaction.atomic():
+        taken = list(rows.select_for_update(skip_locked=True)[:limit])
+        rows.model.objects.filter(pk__in=[row.pk for row in taken]
+                                  ).update(**values)
+    for row in taken:
+        for field, value in values.items():
+            setattr(row, field, value)
+    return taken
+
+
+def leased(model, now):
+    """Filter of NEW rows and of rows whose worker lease expired"""
+    return (models.Q(status=model.Status.NEW) |
+            models.Q(status=model.Status.IN_PROGRESS,
+                     claimed_at__lt=now - model.LEASE))
+
+
 class DayOfWeek(models.IntegerChoices):
     MONDAY = 0, 'Понеділок'
     TUESDAY = 1, 'Вівторок'
@@ -67,13 +98,33 @@ class ScheduleFile(models.Model):
     class Status(models.IntegerChoices):
         NEW = 1
         PROCESSED = 2
+        IN_PROGRESS = 3
 
     status = models.IntegerField(choices=Status.choices, default=Status.NEW)
+    # sha256 of the file content last processed successfully
+    content_hash = models.CharField(max_length=64, blank=True, default='')
+    # when a worker took the file, it may be taken again after the lease
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    # ImportStats.as_dict() of the last import: phase seconds and counters
+    import_stats = models.JSONField(null=True, blank=True)
+
+    LEASE = timedelta(minutes=30)
 
     class Meta:
         db_table = 'ScheduleFiles'
         unique_together = (("semester", "faculty"),)
 
+    @classmethod
+    def claim(cls, limit=1):
+        """Take NEW files, or files whose worker lease expired, for processing
+
+        Returns:
+            List[ScheduleFile]: up to limit files marked IN_PROGRESS
+        """
+        now = datetime.now(timezone.utc)
+        return claim_rows(cls.objects.filter(leased(cls, now)).order_by('pk'),
+                          limit, status=cls.Status.IN_PROGRESS, claimed_at=now)
+
     def __str__(self) -> str:
         return self.file.name
 
@@ -128,6 +179,11 @@ class Subject(models.Model):
     title = models.CharField(max_length=128)
     courseurl = models.URLField(blank=True, default='')
     course_id = models.IntegerField(null=True, default=None)
+    # how course_id was matched, see schedule_file_parser.CourseMatcher
+    course_similarity = models.FloatField(null=True, default=None)
+    course_fingerprint = models.CharField(max_length=40, blank=True,
+                                          default='')
+    course_matched_until = models.BigIntegerField(null=True, default=None)
 
     class Meta:
         db_table = 'Subjects'
@@ -193,3 +249,505 @@ class Lesson(models.Model):
         if self.weekfrequency == WeekFrequency.DENOMINATOR:
             name += ' (знаменник)'
         return f'{self.get_dayofweek_display()} {self.lesson_number.starttime}: {self.subject.title}'
+
+
+class CalendarSyncJob(models.Model):
+    """Google Calendar update requested by a user, run by calendar_sync"""
+    id = models.AutoField(primary_key=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             on_delete=models.CASCADE)
+    email = models.CharField(max_length=100)  # email of the Moodle user
+
+    class Action(models.IntegerChoices):
+        UPDATE = 1
+        DELETE = 2
+
+    action = models.IntegerField(choices=Action.choices, default=Action.UPDATE)
+
+    class Status(models.IntegerChoices):
+        NEW = 1
+        IN_PROGRESS = 2
+        DONE = 3
+        FAILED = 4
+
+    status = models.IntegerField(choices=Status.choices, default=Status.NEW)
+    message = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    # when a worker took the job, it may be taken again after the lease
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # bulk update of all calendars the job belongs to
+    run = models.ForeignKey('CalendarSyncRun', null=True, blank=True,
+                            on_delete=models.SET_NULL, related_name='jobs')
+
+    LEASE = timedelta(minutes=10)
+
+    class Meta:
+        db_table = 'CalendarSyncJobs'
+
+    @classmethod
+    def enqueue(cls, user, action, email) -> 'CalendarSyncJob':
+        """Add a job for the user, or update the NEW job already waiting
+
+        Repeated requests of a user collapse into one pending job, the
+        last requested action and email win.
+        """
+        with transaction.atomic():
+            # serializes enqueues of the same user
+            get_user_model().objects.select_for_update().get(pk=user.pk)
+            job = cls.objects.filter(user=user, status=cls.Status.NEW).first()
+            if job:
+                job.action, job.email = action, email
+                job.save(update_fields=['action', 'email'])
+                return job
+            return cls.objects.create(user=user, action=action, email=email)
+
+    @classmethod
+    def claim(cls, limit=1, run=None):
+        """Take NEW jobs, or jobs whose worker lease expired, for processing
+
+        A user calendar is updated by one worker at a time: jobs of users
+        with a job in progress are not taken, nor jobs waiting behind an
+        earlier job of the same user. A run does not take jobs of users
+        waiting for calendar_sync, they are updated by it first.
+
+        Args:
+            limit (int): maximum number of jobs
+            run (CalendarSyncRun): take jobs of this run instead of the
+                jobs of no run, calendar_sync leaves runs to
+                calendar_sync_all and its rate limit
+
+        Returns:
+            List[CalendarSyncJob]: up to limit jobs marked IN_PROGRESS
+        """
+        now = datetime.now(timezone.utc)
+        queue = cls.objects.filter(run=None) if run is None else run.jobs.all()
+        busy = cls.objects.filter(status=cls.Status.IN_PROGRESS,
+                                  claimed_at__gte=now - cls.LEASE)
+        jobs = (queue.filter(leased(cls, now))
+                .exclude(user__in=busy.values('user_id'))
+                .exclude(Exists(queue.filter(leased(cls, now),
+                                             user=OuterRef('user'),
+                                             pk__lt=OuterRef('pk')))))
+        if run is not None:
+            jobs = jobs.exclude(user__in=cls.objects.filter(
+                run=None, status=cls.Status.NEW).values('user_id'))
+        return claim_rows(jobs.order_by('pk'), limit,
+                          status=cls.Status.IN_PROGRESS, claimed_at=now)
+
+    @classmethod
+    def enqueue_updates(cls, user_ids):
+        """Add UPDATE jobs for users, unless a NEW job is already waiting
+
+        Jobs use the email of the last job of the user, users who never
+        updated their calendar are skipped.
+        """
+        pending = set(cls.objects.filter(user_id__in=user_ids,
+                                         status=cls.Status.NEW)
+                      .values_list('user_id', flat=True))
+        emails = dict()
+        for user_id, email in (cls.objects
+                               .filter(user_id__in=set(user_ids) - pending)
+                               .order_by('pk').values_list('user_id', 'email')):
+            emails[user_id] = email  # of the last job
+        cls.objects.bulk_create(cls(user_id=user_id, email=email)
+                                for user_id, email in emails.items())
+        return len(emails)
+
+    def finish(self, status, message):
+        self.status = status
+        self.message = message
+        self.finished_at = datetime.now(timezone.utc)
+        self.save(update_fields=['status', 'message', 'finished_at'])
+
+    @property
+    def finished(self):
+        return self.status in (self.Status.DONE, self.Status.FAILED)
+
+    def __str__(self) -> str:
+        return f'{self.user} {self.get_action_display()}'
+
+
+class CalendarSyncRun(models.Model):
+    """Update of all user calendars by calendar_sync_all
+
+    Jobs of the run are its checkpoint, an interrupted run is resumed by
+    processing the jobs that are not finished.
+    """
+    id = models.AutoField(primary_key=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'CalendarSyncRuns'
+
+    def add_jobs(self, users):
+        """Add UPDATE jobs of users, unfinished jobs of earlier runs join it
+
+        Users with a NEW job waiting for calendar_sync, and users whose
+        last job deleted their calendar are skipped. Jobs use the email of
+        the last job of the user or the user email, users without any are
+        skipped.
+
+        Args:
+            users (Iterable[Tuple[int, str]]): user ids and emails
+
+        Returns:
+            int: number of jobs of the run
+        """
+        emails = dict(users)
+        with transaction.atomic():
+            jobs = CalendarSyncJob.objects.filter(user_id__in=emails.keys())
+            # jobs of a taken lease keep it, they are not taken twice
+            jobs.filter(run__isnull=False,
+                        status__in=[CalendarSyncJob.Status.NEW,
+                                    CalendarSyncJob.Status.IN_PROGRESS]
+                        ).update(run=self)
+            pending_users = set(
+                jobs.filter(models.Q(run=self) |
+                            models.Q(run=None,
+                                     status=CalendarSyncJob.Status.NEW))
+                .values_list('user_id', flat=True))
+
+            skipped = set()
+            for user_id, action, email in (
+                CalendarSyncJob.objects
+                .filter(user_id__in=emails.keys() - pending_users)
+                .order_by('pk').values_list('user_id', 'action', 'email')
+            ):
+                emails[user_id] = email  # of the last job
+                if action == CalendarSyncJob.Action.DELETE:
+                    skipped.add(user_id)
+                else:
+                    skipped.discard(user_id)
+
+            CalendarSyncJob.objects.bulk_create(
+                (CalendarSyncJob(user_id=user_id, email=emails[user_id],
+                                 run=self)
+                 for user_id in emails.keys() - pending_users - skipped
+                 if emails[user_id]),
+                batch_size=500)
+        return self.jobs.count()
+
+    def finish(self):
+        self.finished_at = datetime.now(timezone.utc)
+        self.save(update_fields=['finished_at'])
+
+    def __str__(self) -> str:
+        return f'Calendar sync run {self.pk}'
+
+
+class CalendarSyncState(models.Model):
+    """Events of this app in the user Google calendar as last fetched"""
+    user = models.OneToOneField(settings.AUTH_USER_MODEL,
+                                on_delete=models.CASCADE, primary_key=True)
+    # nextSyncToken of the last events list, empty before the first one
+    sync_token = models.TextField(blank=True, default='')
+    events = models.JSONField(default=dict)  # API event dicts by event id
+    # when lessons were last compared with the calendar events
+    reconciled_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'CalendarSyncStates'
+
+
+class SentEvent(models.Model):
+    """Lesson event as it was last sent to a Google calendar"""
+    # not a foreign key, the event is deleted after its lesson
+    lesson_id = models.UUIDField()
+    event_id = models.CharField(max_length=1024)
+    fingerprint = models.CharField(max_length=40)  # Event.fingerprint
+    until = models.DateField()  # end of the event recurrence
+
+    class Meta:
+        abstract = True
+
+
+class PushedEvent(SentEvent):
+    """Lesson event as it was last sent to the user Google calendar"""
+    id = models.AutoField(primary_key=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             on_delete=models.CASCADE)
+
+    class Meta:
+        db_table = 'PushedEvents'
+        unique_together = (('user', 'lesson_id'),)
+
+
+class LessonChange(models.Model):
+    """Lesson changed after calendars were updated
+
+    Calendars of users of the lesson groups and course are updated by
+    calendar_sync, see g_calendar.fan_out_lesson_changes.
+    """
+    id = models.AutoField(primary_key=True)
+    # not a foreign key, the lesson may be deleted
+    lesson_id = models.UUIDField()
+    course_id = models.IntegerField(null=True, default=None)
+    groups = models.JSONField(default=list)  # group names
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'LessonChanges'
+
+    @classmethod
+    def record(cls, lesson_ids):
+        """Add changes of lessons with their current groups and course"""
+        lesson_ids = list(lesson_ids)
+        changes = dict()
+        for first in range(0, len(lesson_ids), 500):
+            for lesson_id, course_id, group in (
+                Lesson.objects.filter(id__in=lesson_ids[first:first + 500])
+                .values_list('id', 'subject__course_id', 'groups')
+            ):
+                change = changes.setdefault(
+                    lesson_id, cls(lesson_id=lesson_id, course_id=course_id))
+                if group is not None:
+                    change.groups.append(group)
+        cls.objects.bulk_create(changes.values(), batch_size=500)
+        ScheduleVersion.touch(
+            {group for change in changes.values() for group in change.groups},
+            {change.course_id for change in changes.values()
+             if change.course_id is not None})
+
+
+class CalendarAudience(models.Model):
+    """Group or course whose lesson changes update a user calendar
+
+    Stored from Moodle cohorts and enrolments when the calendar is
+    updated. A student gets lessons of its groups in its courses, a
+    teacher all lessons of its courses.
+    """
+    id = models.AutoField(primary_key=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             on_delete=models.CASCADE)
+    group = models.CharField(max_length=64, blank=True, default='',
+                             db_index=True)  # cohort of a student
+    course_id = models.IntegerField(null=True, default=None,
+                                    db_index=True)  # enrolled course
+    teacher = models.BooleanField(default=False)
+
+    class Meta:
+        db_table = 'CalendarAudiences'
+
+
+class ScheduleVersion(models.Model):
+    """When lessons of a group or a course changed last
+
+    Versions of calendar feeds, see main.calendar_feed.
+    """
+    key = models.CharField(max_length=80, primary_key=True)
+    changed_at = models.DateTimeField()
+
+    class Meta:
+        db_table = 'ScheduleVersions'
+
+    @staticmethod
+    def keys(groups, course_ids):
+        return ([f'group:{group}' for group in groups] +
+                [f'course:{course_id}' for course_id in course_ids])
+
+    @classmethod
+    def touch(cls, groups, course_ids):
+        keys = cls.keys(groups, course_ids)
+        if not keys:
+            return
+        now = datetime.now(timezone.utc)
+        cls.objects.filter(key__in=keys).update(changed_at=now)
+        cls.objects.bulk_create([cls(key=key, changed_at=now) for key in keys],
+                                ignore_conflicts=True, batch_size=500)
+
+    @classmethod
+    def last_changed(cls, groups, course_ids):
+        """Latest change of the groups and courses, None if never changed"""
+        return (cls.objects.filter(key__in=cls.keys(groups, course_ids))
+                .aggregate(models.Max('changed_at'))['changed_at__max'])
+
+
+def new_feed_token():
+    return secrets.token_urlsafe(32)
+
+
+class CalendarFeed(models.Model):
+    """iCalendar feed of lessons subscribed by calendar clients
+
+    A user gets the feed of its lessons on the index page, feeds of a
+    group or a Moodle teacher are added by administrators. The token is
+    the only credential of the feed.
+    """
+    token = models.CharField(max_length=64, primary_key=True,
+                             default=new_feed_token, editable=False)
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, null=True,
+                                blank=True, on_delete=models.CASCADE)
+    group = models.ForeignKey(Group, null=True, blank=True,
+                              on_delete=models.CASCADE)
+    teacher_id = models.IntegerField(null=True, blank=True)  # Moodle user id
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'CalendarFeeds'
+
+    def __str__(self) -> str:
+        if self.user_id:
+            return f'{self.user} feed'
+        if self.group_id:
+            return f'{self.group_id} feed'
+        return f'Teacher {self.teacher_id} feed'
+
+
+class GroupCalendar(models.Model):
+    """Google calendar of a group, owned by the service account
+
+    Students of the group subscribe to it instead of getting copies of
+    the group lessons, see g_calendar.Student.subscribe_group_calendars.
+    It has lessons of the courses all members are enrolled in, students
+    get copies of the others.
+    """
+    group = models.OneToOneField(Group, on_delete=models.CASCADE,
+                                 primary_key=True)
+    calendar_id = models.CharField(max_length=1024, blank=True, default='')
+    outdated = models.BooleanField(default=True)  # lessons changed since sync
+    synced_at = models.DateTimeField(null=True, blank=True)
+    # courses of the calendar lessons, all group members are enrolled in
+    course_ids = models.JSONField(default=list)
+    failures = models.IntegerField(default=0)  # failed syncs in a row
+    retry_at = models.DateTimeField(null=True, blank=True)  # after a failure
+
+    RETRY_DELAY = timedelta(minutes=1)  # doubled by each failure
+    MAX_RETRY_DELAY = timedelta(hours=6)
+
+    class Meta:
+        db_table = 'GroupCalendars'
+
+    @classmethod
+    def claim_outdated(cls, limit=1):
+        """Take outdated calendars for a sync, they are up to date until
+        their lessons change again
+
+        Calendars whose sync failed are taken after their retry_at.
+
+        Returns:
+            List[GroupCalendar]: up to limit calendars
+        """
+        now = datetime.now(timezone.utc)
+        return claim_rows(cls.objects.select_related('group')
+                          .filter(models.Q(retry_at=None) |
+                                  models.Q(retry_at__lte=now), outdated=True)
+                          .exclude(calendar_id='').order_by('pk'),
+                          limit, outdated=False)
+
+    def sync_failed(self):
+        """Sync the calendar again after a delay doubled by each failure"""
+        delay = min(self.RETRY_DELAY * 2 ** self.failures,
+                    self.MAX_RETRY_DELAY)
+        self.failures += 1
+        self.retry_at = datetime.now(timezone.utc) + delay
+        GroupCalendar.objects.filter(pk=self.pk).update(
+            outdated=True, failures=self.failures, retry_at=self.retry_at)
+
+    def __str__(self) -> str:
+        return f'{self.group_id} calendar'
+
+
+class GroupCalendarEvent(SentEvent):
+    """Lesson event as it was last sent to a group calendar"""
+    id = models.AutoField(primary_key=True)
+    group_calendar = models.ForeignKey(GroupCalendar, on_delete=models.CASCADE,
+                                       related_name='events')
+
+    class Meta:
+        db_table = 'GroupCalendarEvents'
+        unique_together = (('group_calendar', 'lesson_id'),)
+
+
+class GroupCalendarMember(models.Model):
+    """User subscribed to a group calendar
+
+    A user whose Google token refused to add the calendar to the user list
+    is stored with refused_token and gets copies of the group lessons
+    until the user logs in again.
+    """
+    id = models.AutoField(primary_key=True)
+    group_calendar = models.ForeignKey(GroupCalendar, on_delete=models.CASCADE,
+                                       related_name='members')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             on_delete=models.CASCADE)
+    # reader ACL rule of the user
+    rule_id = models.CharField(max_length=1024, blank=True)
+    # Student.token_hash of the refused token
+    refused_token = models.CharField(max_length=40, blank=True)
+
+    class Meta:
+        db_table = 'GroupCalendarMembers'
+        unique_together = (('group_calendar', 'user'),)
+
+
+class MoodleSnapshot(models.Model):
+    """Refresh state of a local copy of a Moodle table
+
+    See main.moodle_snapshot.
+    """
+    table = models.CharField(max_length=64, primary_key=True)
+    # newest Moodle timemodified copied, rows modified since are copied next
+    timemodified = models.BigIntegerField(null=True, default=None)
+    refreshed_at = models.DateTimeField(null=True, blank=True)
+    changed_at = models.DateTimeField(null=True, blank=True)  # rows changed
+
+    class Meta:
+        db_table = 'MoodleSnapshots'
+
+    @classmethod
+    def version(cls):
+        """Last change of any local copy, None before the first refresh"""
+        return cls.objects.aggregate(
+            models.Max('changed_at'))['changed_at__max']
+
+
+class MoodleUser(models.Model):
+    """mdl_user row copied by moodle_snapshot"""
+    id = models.BigIntegerField(primary_key=True)
+    email = models.CharField(max_length=100, db_index=True)
+    firstname = models.CharField(max_length=100)
+    lastname = models.CharField(max_length=100)
+    timemodified = models.BigIntegerField()
+
+    class Meta:
+        db_table = 'MoodleUsers'
+
+    def __str__(self) -> str:
+        return f'{self.firstname} {self.lastname}'
+
+
+class MoodleEnrolment(models.Model):
+    """mdl_user_enrolments row with the course of its enrol method"""
+    id = models.BigIntegerField(primary_key=True)
+    user_id = models.BigIntegerField(db_index=True)
+    course_id = models.BigIntegerField(db_index=True)
+    status = models.BigIntegerField()  # 0 is active
+    timemodified = models.BigIntegerField()
+
+    class Meta:
+        db_table = 'MoodleEnrolments'
+
+
+class MoodleCohortMember(models.Model):
+    """mdl_cohort_members row with the cohort name, a group name"""
+    id = models.BigIntegerField(primary_key=True)
+    cohort_id = models.BigIntegerField()
+    cohort_name = models.CharField(max_length=254)
+    user_id = models.BigIntegerField(db_index=True)
+    timeadded = models.BigIntegerField()
+
+    class Meta:
+        db_table = 'MoodleCohortMembers'
+
+
+class MoodleRoleAssignment(models.Model):
+    """mdl_role_assignments row with the role short name"""
+    id = models.BigIntegerField(primary_key=True)
+    user_id = models.BigIntegerField(db_index=True)
+    role = models.CharField(max_length=100)
+    timemodified = models.BigIntegerField()
+
+    class Meta:
+        db_table = 'MoodleRoleAssignments'
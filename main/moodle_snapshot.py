@@ -0,0 +1,117 @@
+"""Local copies of the Moodle tables read by calendar updates
+
+Calendar updates and feeds read users, enrolments, cohorts and roles from
+these tables in the schedule database instead of querying Moodle on every
+request. refresh_snapshot() copies the rows modified since the previous
+refresh, found by Moodle timemodified columns, and removes the rows
+deleted in Moodle.
+"""
+from datetime import datetime, timezone
+from functools import reduce
+from operator import or_
+from typing import Dict, NamedTuple, Tuple
+
+from django.db import transaction
+from django.db.models import Q
+
+from main import models
+from moodle.models import (MdlCohortMembers, MdlRoleAssignments, MdlUser,
+                           MdlUserEnrolments)
+
+ROWS_PER_QUERY = 1000
+
+
+class Snapshot(NamedTuple):
+    model: type  # local table
+    source: type  # Moodle model
+    fields: Dict[str, str]  # local field -> Moodle field
+    time_fields: Tuple[str, ...]  # Moodle fields changed with the row
+
+
+SNAPSHOTS = (
+    Snapshot(models.MoodleUser, MdlUser,
+             dict(id='id', email='email', firstname='firstname',
+                  lastname='lastname', timemodified='timemodified'),
+             ('timemodified',)),
+    Snapshot(models.MoodleEnrolment, MdlUserEnrolments,
+             dict(id='id', user_id='userid', course_id='enrolid__courseid',
+                  status='status', timemodified='timemodified'),
+             ('timemodified',)),
+    # members are copied again when their cohort is renamed
+    Snapshot(models.MoodleCohortMember, MdlCohortMembers,
+             dict(id='id', cohort_id='cohortid', cohort_name='cohortid__name',
+                  user_id='userid', timeadded='timeadded'),
+             ('timeadded', 'cohortid__timemodified')),
+    Snapshot(models.MoodleRoleAssignment, MdlRoleAssignments,
+             dict(id='id', user_id='userid', role='roleid__shortname',
+                  timemodified='timemodified'),
+             ('timemodified',)),
+)
+
+
+def refresh_snapshot(snapshot: Snapshot):
+    """Copy Moodle rows changed since the previous refresh
+
+    Rows modified in the second of the previous refresh are read again,
+    so rows saved during it are not missed, only rows that differ from
+    the local ones are written.
+
+    Returns:
+        Tuple[int, int]: numbers of copied and deleted rows
+    """
+    state, _ = models.MoodleSnapshot.objects.get_or_create(
+        table=snapshot.model._meta.db_table)
+    rows = snapshot.source.objects.all()
+    if state.timemodified is not None:
+        rows = rows.filter(reduce(or_, (
+            Q(**{f'{field}__gte': state.timemodified})
+            for field in snapshot.time_fields)))
+    rows = rows.values_list(*snapshot.fields.values(), *snapshot.time_fields)
+
+    copied, timemodified = 0, state.timemodified or 0
+    for chunk in chunks(rows):
+        timemodified = max(timemodified, *(
+            time or 0 for row in chunk for time in row[len(snapshot.fields):]))
+        stored = {row[0]: row for row in snapshot.model.objects
+                  .filter(pk__in=[row[0] for row in chunk])
+                  .values_list(*snapshot.fields)}
+        objects = [snapshot.model(**dict(zip(snapshot.fields, row)))
+                   for row in (row[:len(snapshot.fields)] for row in chunk)
+                   if stored.get(row[0]) != row]
+        if not objects:
+            continue
+        with transaction.atomic():
+            snapshot.model.objects.filter(
+                pk__in=[obj.pk for obj in objects]).delete()
+            snapshot.model.objects.bulk_create(objects)
+        copied += len(objects)
+
+    # deleted rows have no timemodified, compare ids
+    deleted = set(snapshot.model.objects.values_list('pk', flat=True))
+    for chunk in chunks(snapshot.source.objects.values_list('id')):
+        deleted.difference_update(row[0] for row in chunk)
+    deleted = sorted(deleted)
+    for first in range(0, len(deleted), ROWS_PER_QUERY):
+        snapshot.model.objects.filter(
+            pk__in=deleted[first:first + ROWS_PER_QUERY]).delete()
+
+    now = datetime.now(timezone.utc)
+    state.timemodified, state.refreshed_at = timemodified, now
+    if copied or deleted:
+        state.changed_at = now
+    state.save()
+    return copied, len(deleted)
+
+
+def chunks(rows):
+    """Yield lists of values_list rows by id, the first value is the id"""
+    last_id = None
+    while True:
+        query = rows.order_by('id')
+        if last_id is not None:
+            query = query.filter(id__gt=last_id)
+        chunk = list(query[:ROWS_PER_QUERY])
+        if not chunk:
+            return
+        yield chunk
+        last_id = chunk[-1][0]
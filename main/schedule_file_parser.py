@@ -1,14 +1,30 @@
 from datetime import datetime
+from pathlib import Path
+import gzip
+import hashlib
+import json
+import os
 import re
 import string
-from typing import List
+import tempfile
+import time
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from xml.etree import ElementTree
+from collections import Counter, defaultdict
+from typing import Dict, List, NamedTuple, Tuple
 from difflib import SequenceMatcher
 
+from django.db import connections, transaction
 from openpyxl import load_workbook
+from openpyxl.utils.cell import coordinate_to_tuple, get_column_letter
+from openpyxl.worksheet.cell_range import CellRange, MultiCellRange
 from chunkator import chunkator
 
 from main import models
 from moodle.models import MdlCourse
+from schedule_nubip.settings import SCHEDULE_CACHE_DIR
 
 ALPHABET_LIST = list(string.ascii_uppercase)
 
@@ -34,10 +50,113 @@ REDUCED_GROUP_STRINGS = ('с.т.', "ст", "ск")
 
 LESSON_NAME_SIMILARITY_THRESHOLD = 0.6
 
+BULK_BATCH_SIZE = 500
+
+# lesson fields written from the schedule file
+LESSON_FIELDS = ['subject', 'dayofweek', 'weekfrequency', 'lesson_number',
+                 'semester', 'location']
+LESSON_FIELD_ATTNAMES = ['subject_id', 'dayofweek', 'weekfrequency',
+                         'lesson_number_id', 'semester_id', 'location']
+
+SUBJECT_MATCH_FIELDS = ['course_id', 'course_similarity', 'course_fingerprint',
+                        'course_matched_until']
+
+SHARDS_PER_WORKER = 4  # column shards per process, evens out shard sizes
+
+SCHEDULE_VERSION = 1  # change when read_schedule() result changes
+
+NGRAM_SIZE = 3  # course names prefilter
+NGRAM_SEED_CANDIDATES = 10  # names scored first by shared ngrams count
+
 days = ['Monday', 'Tuesday', 'Wednesday',
         'Thursday', 'Friday', 'Saturday', 'Sunday']
 
 
+def file_hash(file) -> str:
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cached_schedule_path(content_hash) -> Path:
+    return Path(SCHEDULE_CACHE_DIR) / \
+        f'{content_hash}.v{SCHEDULE_VERSION}.json.gz'
+
+
+def load_cached_schedule(content_hash) -> Dict[str, list] | None:
+    """Return ScheduleSheet.read_schedule() result saved for a file"""
+    try:
+        with gzip.open(cached_schedule_path(content_hash), 'rt',
+                       encoding='utf-8') as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):  # not cached or damaged
+        return None
+
+
+def save_cached_schedule(content_hash, schedule: Dict[str, list]):
+    path = cached_schedule_path(content_hash)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # a file of its own, workers may cache the same content at once
+    with tempfile.NamedTemporaryFile(dir=path.parent, suffix='.tmp',
+                                     delete=False) as tmp_file:
+        try:
+            with gzip.open(tmp_file, 'wt', encoding='utf-8') as cache_file:
+                json.dump(schedule, cache_file, ensure_ascii=False,
+                          separators=(',', ':'), default=str)
+        except BaseException:
+            os.unlink(tmp_file.name)
+            raise
+    os.replace(tmp_file.name, path)
+
+
+class ImportStats:
+    """Phase timings and counters of one schedule import
+
+    Phases are wall seconds of import steps, a phase entered several
+    times adds up. Counters include queries run on both databases inside
+    phases. as_dict() is stored in ScheduleFile.import_stats.
+    """
+
+    def __init__(self):
+        self.phases = dict()  # phase name -> seconds
+        self.counters = Counter()
+
+    @contextmanager
+    def phase(self, name):
+        def count_query(execute, sql, params, many, context):
+            self.counters['db_queries'] += 1
+            return execute(sql, params, many, context)
+
+        started = time.perf_counter()
+        try:
+            with connections['default'].execute_wrapper(count_query), \
+                    connections['moodle'].execute_wrapper(count_query):
+                yield
+        finally:
+            self.phases[name] = (self.phases.get(name, 0.0) +
+                                 time.perf_counter() - started)
+
+    def count(self, name, number=1):
+        self.counters[name] += number
+
+    def update(self, other: 'ImportStats'):
+        """Add phases and counters of other, e.g. read by another process"""
+        for name, seconds in other.phases.items():
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+        self.counters.update(other.counters)
+
+    def as_dict(self):
+        return dict(phases={name: round(seconds, 4)
+                            for name, seconds in self.phases.items()},
+                    counters=dict(self.counters))
+
+    def __str__(self) -> str:
+        return ', '.join(
+            [f'{name} {seconds:.2f}s' for name, seconds in self.phases.items()] +
+            [f'{name} {number}' for name, number in self.counters.items()])
+
+
 def remove_brackets(string):
     pattern = r"\([^()]*\)"
     result = re.sub(pattern, "", string)
@@ -45,50 +164,382 @@ def remove_brackets(string):
 
 
 def find_course(name):
-    course = None
-    max_similarity = 0
-    for it_course in chunkator(MdlCourse.objects.all(), 100):
-        # search course by partial match
-        shortname = remove_brackets(it_course.shortname)
-        fullname = remove_brackets(it_course.fullname)
-        shortname_similarity = SequenceMatcher(
-            None, shortname, name).ratio()
-        fullname_similarity = SequenceMatcher(None, fullname, name).ratio()
-        similarity = max(shortname_similarity, fullname_similarity)
-        # print(f'checking course {it_course.fullname}. similarity = {similarity}')
-        if similarity < LESSON_NAME_SIMILARITY_THRESHOLD or \
-            similarity < max_similarity:
-            continue
-        max_similarity = similarity
-        course = it_course
-    return course
+    return CourseMatcher().find(name)
+
+
+def ngrams(text, size=NGRAM_SIZE):
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def course_fingerprint(shortname, fullname) -> str:
+    """Identifies the names a course was matched by"""
+    return hashlib.sha1(f'{shortname}\n{fullname}'.encode()).hexdigest()
+
+
+class CourseMatch(NamedTuple):
+    """Moodle course matched to a subject name, stored in Subject"""
+    course_id: int | None
+    similarity: float | None
+    fingerprint: str  # course_fingerprint() of the course, '' if no course
+    matched_until: int  # newest mdl_course.timemodified compared with
+
+
+class CourseMatcher:
+    """Moodle course names indexed once for repeated course lookups
+
+    Returns the same course as a linear scan over mdl_course would: the
+    course with the best SequenceMatcher ratio of its bracket-stripped
+    short or full name, the latest course id winning a tie. N-gram overlap
+    only decides which names get scored first; the remaining names are
+    skipped using exact upper bounds of the ratio (length and character
+    counts), so a possible better match is never dropped.
+
+    Matches stored in Subject rows by earlier imports are reused: only
+    courses modified after the match (by mdl_course.timemodified) are
+    compared with the name. All courses are compared again when the
+    matched course was renamed or deleted.
+    """
+
+    def __init__(self, stored_matches=True):
+        """
+        Args:
+            stored_matches (bool): reuse matches stored in Subject rows
+        """
+        self.courses = None  # loaded on the first full search
+        self.loaded_until = 0  # newest timemodified of loaded courses
+        self.names = list()  # (course id, name, character counts)
+        self.ngram_index = defaultdict(list)  # ngram -> indexes in names
+        self.matches = dict()  # memoized CourseMatch by searched name
+        self.comparisons = 0  # SequenceMatcher ratios computed
+        self.reused = 0  # stored matches reused
+        # stored CourseMatch by subject title, loaded on the first search
+        self.stored = None if stored_matches else dict()
+        self.fingerprints = dict()  # course id -> course_fingerprint()
+        self.changed = dict()  # timemodified -> changed_since() result
+
+    def load(self):
+        self.courses = dict()
+        for course in chunkator(MdlCourse.objects.all(), 1000):
+            self.courses[course.id] = course
+            self.loaded_until = max(self.loaded_until, course.timemodified)
+            self.fingerprints[course.id] = course_fingerprint(
+                course.shortname, course.fullname)
+            for name in {remove_brackets(course.shortname),
+                         remove_brackets(course.fullname)}:
+                for ngram in ngrams(name):
+                    self.ngram_index[ngram].append(len(self.names))
+                self.names.append((course.id, name, Counter(name)))
+
+    def load_stored(self):
+        self.stored = dict()
+        for title, *match in (models.Subject.objects
+                              .filter(course_matched_until__isnull=False)
+                              .order_by('pk')
+                              .values_list('title', 'course_id',
+                                           'course_similarity',
+                                           'course_fingerprint',
+                                           'course_matched_until')):
+            self.stored.setdefault(title, CourseMatch(*match))
+
+        # current names of the matched courses
+        course_ids = sorted({match.course_id for match in self.stored.values()
+                             if match.course_id is not None})
+        for first in range(0, len(course_ids), 1000):
+            for course_id, shortname, fullname in (
+                MdlCourse.objects
+                .filter(id__in=course_ids[first:first + 1000])
+                .values_list('id', 'shortname', 'fullname')
+            ):
+                self.fingerprints[course_id] = course_fingerprint(shortname,
+                                                                  fullname)
+
+    def find(self, name):
+        course_id = self.find_id(name)
+        if course_id is None:
+            return None
+        if self.courses is None:
+            self.load()
+        return self.courses.get(course_id)
+
+    def find_id(self, name):
+        return self.find_match(name).course_id
+
+    def find_match(self, name) -> CourseMatch:
+        if name not in self.matches:
+            match = self.stored_match(name)
+            if match is None:
+                if self.courses is None:
+                    self.load()
+                similarity, course_id = self.find_course_id(name)
+                match = CourseMatch(None, None, '', self.loaded_until)
+                if course_id in self.courses:
+                    match = CourseMatch(course_id, similarity,
+                                        self.fingerprints[course_id],
+                                        self.loaded_until)
+            else:
+                self.reused += 1
+            self.matches[name] = match
+        return self.matches[name]
+
+    def stored_match(self, name) -> CourseMatch | None:
+        """Stored match of name compared with courses modified since
+
+        Returns:
+            CourseMatch | None: None if there is no stored match or the
+            matched course changed, then all courses have to be compared
+        """
+        if self.stored is None:
+            self.load_stored()
+        match = self.stored.get(name)
+        if match is None:
+            return None
+        if (match.course_id is not None and
+                self.fingerprints.get(match.course_id) != match.fingerprint):
+            return None  # the course was renamed or deleted
+
+        names, changed_until = self.changed_since(match.matched_until)
+        best = (LESSON_NAME_SIMILARITY_THRESHOLD, -1)
+        if match.course_id is not None:
+            best = (match.similarity, match.course_id)
+        similarity, course_id = self.best_match(name, names, best)
+        if course_id == -1:
+            return CourseMatch(None, None, '', changed_until)
+        return CourseMatch(course_id, similarity,
+                           self.fingerprints[course_id], changed_until)
+
+    def changed_since(self, timemodified) -> Tuple[list, int]:
+        """Names of courses modified since timemodified
+
+        Courses modified in the second of timemodified are read again, so
+        courses saved after the previous load in that second are not
+        missed.
+
+        Returns:
+            Tuple[list, int]: (course id, name, character counts) of the
+            courses and their newest timemodified
+        """
+        if timemodified not in self.changed:
+            names, newest = list(), timemodified
+            for course_id, shortname, fullname, modified in (
+                MdlCourse.objects.filter(timemodified__gte=timemodified)
+                .values_list('id', 'shortname', 'fullname', 'timemodified')
+            ):
+                newest = max(newest, modified)
+                self.fingerprints[course_id] = course_fingerprint(shortname,
+                                                                  fullname)
+                for name in {remove_brackets(shortname),
+                             remove_brackets(fullname)}:
+                    names.append((course_id, name, Counter(name)))
+            self.changed[timemodified] = (names, newest)
+        return self.changed[timemodified]
+
+    def best_match(self, name, names, best) -> Tuple[float, int]:
+        """Best of (similarity, course id) best and names scored with name"""
+        matcher = SequenceMatcher(None, b=name)
+        name_counts = Counter(name)
+        for course_id, course_name, counts in names:
+            length = len(course_name) + len(name)
+            common = sum(min(count, name_counts[char])
+                         for char, count in counts.items())
+            if (2.0 * common / length if length else 1.0, course_id) <= best:
+                continue
+            self.comparisons += 1
+            matcher.set_seq1(course_name)
+            best = max(best, (matcher.ratio(), course_id))
+        return best
+
+    def find_course_id(self, name) -> Tuple[float, int]:
+        """Best (similarity, course id) of all courses, id -1 if none"""
+        matcher = SequenceMatcher(None, b=name)  # caches analysis of name
+        name_counts = Counter(name)
+
+        # ratio can not exceed 2 * common characters / total length
+        bounds = dict()
+        for index, (_, course_name, counts) in enumerate(self.names):
+            length = len(course_name) + len(name)
+            if (length and 2.0 * min(len(course_name), len(name)) / length
+                    < LESSON_NAME_SIMILARITY_THRESHOLD):
+                continue
+            common = sum(min(count, name_counts[char])
+                         for char, count in counts.items())
+            bound = 2.0 * common / length if length else 1.0
+            if bound >= LESSON_NAME_SIMILARITY_THRESHOLD:
+                bounds[index] = bound
+
+        # score the names sharing most n-grams first to raise the bar early
+        shared_ngrams = Counter()
+        for ngram in ngrams(name):
+            shared_ngrams.update(index
+                                 for index in self.ngram_index.get(ngram, ())
+                                 if index in bounds)
+        seeds = [index for index, _ in
+                 shared_ngrams.most_common(NGRAM_SEED_CANDIDATES)]
+        candidates = sorted(bounds, key=bounds.get, reverse=True)
+
+        # best (similarity, course id): on equal similarity the latest
+        # course wins, as it did when scanning mdl_course by id
+        best = (LESSON_NAME_SIMILARITY_THRESHOLD, -1)
+        scored = set()
+        for index in seeds + candidates:
+            course_id, course_name, _ = self.names[index]
+            if index in scored or (bounds[index], course_id) <= best:
+                continue
+            scored.add(index)
+            self.comparisons += 1
+            matcher.set_seq1(course_name)
+            best = max(best, (matcher.ratio(), course_id))
+
+        return best
+
+
+class ImportCache:
+    """Reference rows used by one schedule import, resolved in memory
+
+    Lesson numbers, subjects and the faculty specialties and groups are
+    loaded in a few queries. Rows missing in the database are created in
+    memory and inserted in bulk by save_new().
+    """
+
+    def __init__(self, faculty, course_matcher: CourseMatcher):
+        self.faculty = faculty
+        self.course_matcher = course_matcher
+
+        self.lesson_numbers = {
+            lesson_number.lesson_number: lesson_number
+            for lesson_number in models.LessonNumber.objects.all()}
+        self.specialties = {
+            specialty.code: specialty for specialty in
+            models.Specialty.objects.filter(faculty=faculty)}
+        self.groups = {
+            (group.year, group.specialty_id, group.number): group
+            for group in (models.Group.objects
+                          .filter(specialty__faculty=faculty))}
+        self.subjects = dict()
+        for subject in models.Subject.objects.order_by('pk'):
+            self.subjects.setdefault(subject.title, subject)
+
+        self.new_specialties, self.new_groups = dict(), dict()
+        self.new_subjects, self.changed_subjects = dict(), dict()
+        self.matched_titles = set()  # subjects with course_id resolved
+
+    def get_lesson_number(self, number):
+        try:
+            return self.lesson_numbers[int(number)]
+        except KeyError:
+            raise models.LessonNumber.DoesNotExist(
+                f'Lesson number {number} does not exist')
+
+    def get_specialty(self, code):
+        specialty = self.specialties.get(code)
+        if not specialty:
+            specialty = models.Specialty(faculty=self.faculty, code=code)
+            self.specialties[code] = self.new_specialties[code] = specialty
+        return specialty
+
+    def get_group(self, year, specialty, number, type):
+        key = (year, specialty.code, number)
+        group = self.groups.get(key)
+        if not group:
+            group = models.Group(year=year, type=type, specialty=specialty,
+                                 number=number)
+            group.name = group.gen_name()
+            self.groups[key] = self.new_groups[key] = group
+        return group
+
+    def get_subject(self, title):
+        """Subject by title with course_id of the matching Moodle course"""
+        subject = self.subjects.get(title)
+        if not subject:
+            subject = models.Subject(title=title)
+            self.subjects[title] = self.new_subjects[title] = subject
+
+        if title not in self.matched_titles:
+            self.matched_titles.add(title)
+            # TODO: add course url
+            match = self.course_matcher.find_match(title)
+            if match != self.subject_match(subject):
+                (subject.course_id, subject.course_similarity,
+                 subject.course_fingerprint,
+                 subject.course_matched_until) = match
+                if subject.pk:
+                    self.changed_subjects[title] = subject
+
+        return subject
+
+    @staticmethod
+    def subject_match(subject: models.Subject) -> CourseMatch:
+        return CourseMatch(subject.course_id, subject.course_similarity,
+                           subject.course_fingerprint,
+                           subject.course_matched_until)
+
+    def save_new(self):
+        """Insert new reference rows and store changed subject courses"""
+        if self.new_specialties:
+            # specialty code is the primary key, the row may belong to
+            # another faculty and is moved to this one
+            moved = set(models.Specialty.objects
+                        .filter(code__in=self.new_specialties)
+                        .values_list('code', flat=True))
+            models.Specialty.objects.bulk_update(
+                [self.new_specialties[code] for code in moved], ['faculty'])
+            models.Specialty.objects.bulk_create(
+                [specialty for code, specialty in self.new_specialties.items()
+                 if code not in moved])
+
+        if self.new_groups:
+            names = [group.name for group in self.new_groups.values()]
+            existing = set(models.Group.objects.filter(name__in=names)
+                           .values_list('name', flat=True))
+            models.Group.objects.bulk_create(
+                [group for group in self.new_groups.values()
+                 if group.name not in existing],
+                batch_size=BULK_BATCH_SIZE)
+
+        if self.new_subjects:
+            models.Subject.objects.bulk_create(self.new_subjects.values(),
+                                               batch_size=BULK_BATCH_SIZE)
+            # not every database backend returns ids of created rows
+            missing = [title for title, subject in self.new_subjects.items()
+                       if subject.pk is None]
+            for subject in (models.Subject.objects.filter(title__in=missing)
+                            .order_by('pk')):
+                self.new_subjects[subject.title].pk = subject.pk
+
+        # lessons of subjects matched to another course have other users
+        stored_courses = dict(
+            models.Subject.objects
+            .filter(pk__in=[subject.pk
+                            for subject in self.changed_subjects.values()])
+            .values_list('pk', 'course_id'))
+        moved_lessons = list(models.Lesson.objects.filter(subject__in=[
+            subject.pk for subject in self.changed_subjects.values()
+            if stored_courses.get(subject.pk) != subject.course_id
+        ]).values_list('id', flat=True))
+        models.LessonChange.record(moved_lessons)  # users of the old course
+        models.Subject.objects.bulk_update(self.changed_subjects.values(),
+                                           SUBJECT_MATCH_FIELDS,
+                                           batch_size=BULK_BATCH_SIZE)
+        models.LessonChange.record(moved_lessons)
+
+        self.new_specialties, self.new_groups = dict(), dict()
+        self.new_subjects, self.changed_subjects = dict(), dict()
 
 
 class Group:
 
-    def __init__(self, course_name, spec_name, number_info, faculty):
+    def __init__(self, course_name, spec_name, number_info,
+                 cache: ImportCache):
         self.course_name = course_name
-        self.specialty = self.get_specialty(spec_name, faculty)
+        self.specialty = cache.get_specialty(spec_name)
         self.parse_number_info(number_info)  # define type and number
         self.year = self.get_course_year(course_name)
-        self.faculty = faculty
-        self.db_object = self.get_db_object()
+        self.faculty = cache.faculty
+        self.db_object = cache.get_group(self.year, self.specialty,
+                                         self.number, self.type)
 
     def __hash__(self) -> int:
         return hash(self.__str__())
 
-    def get_db_object(self):
-        try:
-            return models.Group.objects.get(year=self.year,
-                                            specialty=self.specialty,
-                                            number=self.number)
-        except models.Group.DoesNotExist:
-            db_object = models.Group(year=self.year, type=self.type,
-                                     specialty=self.specialty,
-                                     number=self.number)
-            db_object.save()
-            return db_object
-
     def parse_number_info(self, number_info):
         self.type = models.Group.Type.BACHELOR
         if any([part in number_info for part in REDUCED_GROUP_STRINGS]):
@@ -117,15 +568,6 @@ class Group:
             except ValueError:  # cannot convert to int
                 pass
 
-    @staticmethod
-    def get_specialty(spec_name, faculty):
-        try:
-            return models.Specialty.objects.get(faculty=faculty, code=spec_name)
-        except models.Specialty.DoesNotExist:
-            spec = models.Specialty(faculty=faculty, code=spec_name)
-            spec.save()
-            return spec
-
     @staticmethod
     def get_course_year(course_name):
         m = re.search(r"\d", course_name)
@@ -144,17 +586,23 @@ class Group:
 
 class Lesson:
 
-    def __init__(self, week_day: str, number: str, info: str, freq, semester):
+    def __init__(self, week_day: str, number: str, info: str, freq, semester,
+                 cache: ImportCache):
         self.week_day = week_day
-        self.lesson_number = models.LessonNumber.objects.get(
-            lesson_number=number)
-        self.subject, self.location = self.parse_info(info)
+        self.lesson_number = cache.get_lesson_number(number)
+        self.subject, self.location = self.parse_info(info, cache)
         self.freq = freq
         self.semester = semester
         self.groups = []
 
     @staticmethod
-    def parse_info(info):
+    def parse_info(info, cache: ImportCache):
+        name, location = Lesson.split_info(info)
+        return cache.get_subject(name), location
+
+    @staticmethod
+    def split_info(info):
+        """Return subject name and location of a lesson cell"""
         m = re.match(r'^((.|\n)+)\s+(\d+(\s+)?к\..+)$', info, re.M)
 
         if not m:
@@ -162,49 +610,48 @@ class Lesson:
 
         name, location = m.group(1), m.group(3)
         name = name.replace('\n', ' ')
-        subject, created = models.Subject.objects.get_or_create(title=name)
-
-        # TODO: add course url
-        course = find_course(name)
-        subject.course_id = course.id if course else None
-        subject.save()
+        return name, location
 
-        return subject, location
-
-    def serialize_to_db(self):
-        print(f'serializing lesson {self.__str__()}')
-    #     return
-        if not self.semester:
-            print("Error!! semester not found")
-            return
-        if not self.groups:
-            print("Error!! groups not found")
-            return
-
-        db_lesson = (models.Lesson.objects.
-                     filter(subject=self.subject, dayofweek=self.week_day,
-                            lesson_number=self.lesson_number,
-                            semester=self.semester)
-                     .first())
-        if not db_lesson:
-            db_lesson = models.Lesson()  # create new
+    def fill_db_object(self, db_lesson: models.Lesson):
         db_lesson.subject = self.subject
         db_lesson.dayofweek = self.week_day
         db_lesson.weekfrequency = self.freq
         db_lesson.lesson_number = self.lesson_number
         db_lesson.semester = self.semester
         db_lesson.location = self.location
-        db_lesson.save()
 
-        for group in self.groups:
-            db_lesson.groups.add(group.db_object)
+    @property
+    def key(self):
+        """Identifies the same lesson parsed from different group columns"""
+        return (self.week_day, self.lesson_number.lesson_number,
+                self.subject.title, self.location, self.freq)
 
-    # def __eq__(self, __o: object) -> bool:
-    #     return (self.info == __o.info and self.week_day == __o.week_day and
-    #             self.number == __o.number)
+    @staticmethod
+    def db_lesson_key(db_lesson: models.Lesson):
+        """Lesson.key of a stored lesson"""
+        return (db_lesson.dayofweek, db_lesson.lesson_number_id,
+                db_lesson.subject.title, db_lesson.location,
+                db_lesson.weekfrequency)
+
+    @property
+    def match_key(self):
+        """Identifies stored lessons this lesson may be, in any room or weeks
+        """
+        return self.key[:3]
+
+    @staticmethod
+    def db_lesson_match_key(db_lesson: models.Lesson):
+        """Lesson.match_key of a stored lesson"""
+        return Lesson.db_lesson_key(db_lesson)[:3]
+
+    def __eq__(self, other: 'Lesson') -> bool:
+        if not isinstance(other, Lesson):
+            return NotImplemented
+
+        return self.key == other.key
 
     def __hash__(self) -> int:
-        return hash(self.__str__())
+        return hash(self.key)
 
     def __repr__(self) -> str:
         return self.__str__()
@@ -220,22 +667,139 @@ class Lesson:
                f'title: {self.subject.title}'
 
 
-class ScheduleFileParser:
+def match_courses(schedule: Dict[str, list], course_matcher: CourseMatcher,
+                  stats: ImportStats) -> Dict[str, CourseMatch]:
+    """Match subject names of schedule lessons to Moodle courses
 
-    def __init__(self, path, faculty, semester) -> None:
-        wb = load_workbook(path)
-        self.ws = wb.active
-        self.faculty = faculty
-        self.semester = semester
+    Returns:
+        Dict[str, CourseMatch]: course matches by subject name
+    """
+    matches = dict()
+    comparisons = course_matcher.comparisons
+    reused = course_matcher.reused
+    with stats.phase('course_matching'):
+        for _, _, _, lesson_info, _ in schedule['lessons']:
+            try:
+                name, _ = Lesson.split_info(lesson_info)
+            except ValueError:
+                continue  # reported when lessons are parsed
+            matches[name] = course_matcher.find_match(name)
+    stats.counters['subjects'] = len(matches)  # may be matched again
+    stats.count('course_match_comparisons',
+                course_matcher.comparisons - comparisons)
+    stats.count('course_matches_reused', course_matcher.reused - reused)
+    return matches
+
+
+class StreamedCell:
+    """Cell of a StreamedSheet"""
+
+    __slots__ = ('row', 'column', 'value')
+
+    def __init__(self, row, column, value):
+        self.row = row
+        self.column = column
+        self.value = value
+
+    @property
+    def coordinate(self):
+        return f'{get_column_letter(self.column)}{self.row}'
 
-        self.define_week_days_ranges()
-        self.lessons = self.parse_lessons()
+
+class StreamedSheet:
+    """Cell values and merged ranges of the active sheet read in one pass
+
+    The workbook is read in openpyxl read-only mode keeping only non-empty
+    values, without cell objects and styles. Read-only worksheets do not
+    provide merged ranges, so <mergeCells> is read from the sheet XML with
+    iterparse. Offers the part of the Worksheet interface used by
+    ScheduleFileParser.
+    """
+
+    def __init__(self, path):
+        wb = load_workbook(path, read_only=True)
+        try:
+            ws = wb.active
+            self.values = dict()
+            for row, row_values in enumerate(
+                    ws.iter_rows(min_row=1, min_col=1, values_only=True),
+                    start=1):
+                for column, value in enumerate(row_values, start=1):
+                    if value is not None:
+                        self.values[(row, column)] = value
+            self.merged_cells = MultiCellRange(self.read_merged_ranges(ws))
+        finally:
+            wb.close()
+
+        self.max_row = max([ws.max_row or 1] +
+                           [row for row, _ in self.values])
+        self.max_column = max([ws.max_column or 1] +
+                              [column for _, column in self.values])
+
+    @staticmethod
+    def read_merged_ranges(ws) -> List[CellRange]:
+        merged_ranges = list()
+        with ws._get_source() as source:  # sheet XML in the archive
+            for _, element in ElementTree.iterparse(source):
+                if element.tag.endswith('}mergeCell'):
+                    merged_ranges.append(CellRange(element.get('ref')))
+                element.clear()  # keep memory bounded on large sheets
+        return merged_ranges
+
+    def cell(self, row, column) -> StreamedCell:
+        return StreamedCell(row, column, self.values.get((row, column)))
+
+    def iter_cols(self, min_row=None, min_col=None, max_row=None,
+                  max_col=None):
+        min_row, min_col = min_row or 1, min_col or 1
+        max_row, max_col = max_row or self.max_row, max_col or self.max_column
+        for column in range(min_col, max_col + 1):
+            yield tuple(self.cell(row, column)
+                        for row in range(min_row, max_row + 1))
+
+
+forked_sheet = None  # ScheduleSheet read by forked worker processes
+
+
+def read_forked_sheet_columns(columns: Tuple[int, int]):
+    forked_sheet.stats = ImportStats()  # counters of this shard only
+    return forked_sheet.read_columns(*columns), forked_sheet.stats
+
+
+def split_columns(min_col, max_col, shards) -> List[Tuple[int, int]]:
+    """Split columns from min_col to max_col into contiguous ranges"""
+    size = max(1, -(-(max_col - min_col + 1) // shards))
+    return [(first, min(first + size - 1, max_col))
+            for first in range(min_col, max_col + 1, size)]
+
+
+class ScheduleSheet:
+    """Active sheet of a schedule workbook, reads it without the database"""
+
+    def __init__(self, path, streaming=False, stats=None) -> None:
+        """
+        Args:
+            streaming (bool): read the sheet with StreamedSheet instead of
+                loading the whole workbook, the result is the same
+            stats (ImportStats): collects timings and counters of reading
+        """
+        self.stats = stats or ImportStats()
+        with self.stats.phase('load'):
+            if streaming:
+                self.ws = StreamedSheet(path)
+            else:
+                wb = load_workbook(path)
+                self.ws = wb.active
+            self.index_merged_ranges()
+        with self.stats.phase('week_days'):
+            self.define_week_days_ranges()
 
     def define_week_days_ranges(self):
         self.week_day_ranges = dict()
         week_day = 0
         for cols in self.ws.iter_cols(min_row=DAYS_START_ROW, min_col=1,
                                       max_row=None, max_col=1):
+            self.stats.count('cells', len(cols))
             for cell in cols:
                 if not cell.value:
                     continue
@@ -244,7 +808,7 @@ class ScheduleFileParser:
                     self.week_day_ranges[row] = week_day
                 week_day += 1
 
-    def parse_group(self, column: int) -> Group | None:
+    def read_group(self, column: int) -> Tuple[str, str, str] | None:
         course_cell = self.ws.cell(COURSES_ROW, column)
         course_name = self.get_cell_value(course_cell)
         if not course_name:
@@ -260,21 +824,69 @@ class ScheduleFileParser:
         if not group_number:
             return None
 
-        return Group(course_name, speciality_name, group_number, self.faculty)
-
-    def parse_lessons(self) -> List[Lesson]:
-        lessons = list()
+        return course_name, speciality_name, group_number
+
+    def read_schedule(self, workers=1) -> Dict[str, list]:
+        """Read group and lesson cells of the sheet
+
+        Args:
+            workers (int): number of processes reading shards of group
+                columns, the result is the same as read by one process
+
+        Returns:
+            Dict[str, list]: 'groups' as [column, course, specialty, group
+            number] and 'lessons' as [column, week day, lesson number,
+            lesson info, frequency] lists, serializable to JSON
+        """
+        min_col, max_col = TITLE_COLUMNS + 1, MAX_COL or self.ws.max_column
+        with self.stats.phase('read_cells'):
+            if workers > 1:
+                shards = split_columns(min_col, max_col,
+                                       workers * SHARDS_PER_WORKER)
+                # forks must not share database sockets, connections are
+                # opened again by the next query; those of a transaction
+                # stay open, workers do not query
+                for connection in connections.all():
+                    if not connection.in_atomic_block:
+                        connection.close()
+                global forked_sheet
+                forked_sheet = self  # workers get it with the forked memory
+                try:
+                    with ProcessPoolExecutor(
+                            workers, mp_context=get_context('fork')) as pool:
+                        results = list()
+                        for result, shard_stats in pool.map(
+                                read_forked_sheet_columns, shards):
+                            results.append(result)
+                            self.stats.update(shard_stats)
+                finally:
+                    forked_sheet = None
+            else:
+                results = [self.read_columns(min_col, max_col)]
+
+        schedule = dict(version=SCHEDULE_VERSION, groups=[], lessons=[])
+        for groups, lessons in results:  # in column order
+            schedule['groups'] += groups
+            schedule['lessons'] += lessons
+        return schedule
+
+    def read_columns(self, min_col, max_col) -> Tuple[list, list]:
+        """Read groups and lessons of columns from min_col to max_col"""
+        groups, lessons = list(), list()
         for column_cells in self.ws.iter_cols(min_row=TITLE_ROWS + 1,
-                                              min_col=TITLE_COLUMNS + 1,
-                                              max_row=MAX_ROW, max_col=MAX_COL):
+                                              min_col=min_col,
+                                              max_row=MAX_ROW, max_col=max_col):
             if not column_cells:
                 continue
 
-            group = self.parse_group(column_cells[0].column)
-            if not group:
+            self.stats.count('cells', len(column_cells))
+            column = column_cells[0].column
+            group_info = self.read_group(column)
+            if not group_info:
                 print(f'Error!! group not found '
-                      f'for column {column_cells[0].column}')
+                      f'for column {column}')
                 continue
+            groups.append([column, *group_info])
 
             for cell in column_cells:
                 lesson_info = self.get_cell_value(cell)
@@ -314,25 +926,10 @@ class ScheduleFileParser:
                           f'for lesson in cell {cell.coordinate}')
                     continue
 
-                try:
-                    lesson = Lesson(week_day, lesson_number,
-                                    lesson_info, freq, self.semester)
-                except ValueError as e:
-                    print(f'Warning!! {e}')
-                    continue
+                lessons.append(
+                    [column, week_day, lesson_number, lesson_info, int(freq)])
 
-                try:
-                    existed_lesson = next(x for x in lessons if x == lesson)
-                    existed_lesson.groups.append(group)
-                except StopIteration:
-                    lesson.groups.append(group)
-                    lessons.append(lesson)
-
-        return lessons
-
-    def serialize_to_db(self):
-        for lesson in self.lessons:
-            lesson.serialize_to_db()
+        return groups, lessons
 
     def get_cell_value(self, cell):
         if not cell:
@@ -359,14 +956,295 @@ class ScheduleFileParser:
         else:
             return cell.column, cell.column
 
+    def index_merged_ranges(self):
+        """Map every cell covered by a merged range to that range
+
+        Built once per worksheet so merged-cell queries are dict lookups
+        instead of a scan over all merged ranges.
+        """
+        self.merged_ranges_index = dict()
+        for merged_range in self.ws.merged_cells.ranges:
+            for row in range(merged_range.min_row, merged_range.max_row + 1):
+                for column in range(merged_range.min_col,
+                                    merged_range.max_col + 1):
+                    # keep the first range if ranges overlap
+                    self.merged_ranges_index.setdefault((row, column),
+                                                        merged_range)
+
     def get_merged_range(self, cell_name):
         if not cell_name:
             return None
-        for merged_range in self.ws.merged_cells.ranges:
-            if cell_name in merged_range:
-                return merged_range
-        return None
+        self.stats.counters['merged_lookups'] += 1
+        return self.merged_ranges_index.get(coordinate_to_tuple(cell_name))
 
     def is_cell_merged(self, cell_name):
         range = self.get_merged_range(cell_name)
         return range is not None
+
+
+class ScheduleFileParser:
+
+    def __init__(self, path, faculty, semester, schedule=None,
+                 streaming=False, course_matcher=None, workers=1,
+                 stats=None) -> None:
+        """
+        Args:
+            schedule (dict): ScheduleSheet.read_schedule() result stored for
+                the same file, the workbook is not loaded when it is given
+            streaming (bool): read the sheet with StreamedSheet
+            course_matcher (CourseMatcher): matcher to reuse, it may already
+                hold course matches of the file subjects
+            workers (int): processes reading the sheet columns
+            stats (ImportStats): collects timings and counters of the
+                import, see the stats attribute
+        """
+        self.faculty = faculty
+        self.semester = semester
+        self.stats = stats or ImportStats()
+        with self.stats.phase('load_references'):
+            self.cache = ImportCache(faculty,
+                                     course_matcher or CourseMatcher())
+
+        if schedule is None:
+            schedule = ScheduleSheet(path, streaming, self.stats) \
+                .read_schedule(workers)
+        self.schedule = schedule
+        self.lessons = self.parse_lessons(schedule)
+
+    def parse_lessons(self, schedule: Dict[str, list]) -> List[Lesson]:
+        with self.stats.phase('groups'):
+            groups = {column: Group(course_name, speciality_name,
+                                    group_number, self.cache)
+                      for column, course_name, speciality_name, group_number
+                      in schedule['groups']}
+        self.stats.count('groups', len(groups))
+
+        match_courses(schedule, self.cache.course_matcher, self.stats)
+
+        lessons: Dict[tuple, Lesson] = dict()  # by Lesson.key
+        with self.stats.phase('lessons'):
+            for column, week_day, lesson_number, lesson_info, freq in \
+                    schedule['lessons']:
+                try:
+                    lesson = Lesson(week_day, lesson_number, lesson_info,
+                                    freq, self.semester, self.cache)
+                except ValueError as e:
+                    print(f'Warning!! {e}')
+                    continue
+
+                # same lesson in several group columns is stored once
+                lessons.setdefault(lesson.key, lesson).groups.append(
+                    groups[column])
+        self.stats.count('lesson_cells', len(schedule['lessons']))
+        self.stats.count('lessons', len(lessons))
+
+        return list(lessons.values())
+
+    def serialize_to_db(self, incremental=False, replace=False):
+        """Write parsed lessons and their groups in one transaction
+
+        Args:
+            incremental (bool): compare with the faculty lessons stored for
+                the semester and write only the difference, keeping ids of
+                unchanged lessons (see update_lessons)
+            replace (bool): delete the faculty lessons of the semester
+                before adding the parsed ones, in the same transaction
+
+        Returns:
+            Dict[str, int]: numbers of created, updated and deleted lessons
+            and of added and removed lesson groups
+        """
+        if not self.semester:
+            print("Error!! semester not found")
+            return dict(created=0, updated=0, deleted=0, groups=0,
+                        removed_groups=0)
+
+        with transaction.atomic():
+            deleted = 0
+            if replace and not incremental:
+                with self.stats.phase('delete_lessons'):
+                    deleted = self.delete_lessons()
+            with self.stats.phase('serialize'):
+                self.cache.save_new()
+                if incremental:
+                    return self.update_lessons()
+                result = self.write_lessons()
+        result['deleted'] = deleted
+        return result
+
+    def delete_lessons(self):
+        """Delete the faculty lessons of the semester, return their number"""
+        lessons = models.Lesson.objects.filter(
+            groups__specialty__faculty=self.faculty, semester=self.semester)
+        lesson_ids = set(lessons.values_list('id', flat=True))
+        # calendars of the lesson users are updated by calendar_sync
+        models.LessonChange.record(lesson_ids)
+        lessons.delete()
+        return len(lesson_ids)
+
+    def write_lessons(self):
+        """Add parsed lessons to the semester
+
+        A lesson of the semester with the same Lesson.key gets the new
+        groups instead of creating a new one, so the same lessons are
+        stored as by update_lessons.
+        """
+        subjects = {lesson.subject.id for lesson in self.lessons}
+        db_lessons = dict()
+        for db_lesson in (models.Lesson.objects
+                          .filter(semester=self.semester,
+                                  subject__in=subjects)
+                          .select_related('subject')
+                          .order_by('pk')):
+            db_lessons.setdefault(Lesson.db_lesson_key(db_lesson), db_lesson)
+
+        lesson_groups = models.Lesson.groups.through
+        existing_groups = set(
+            lesson_groups.objects
+            .filter(lesson__in=list(db_lessons.values()))
+            .values_list('lesson_id', 'group_id'))
+
+        created, new_groups = dict(), dict()
+        for lesson in self.lessons:
+            if not lesson.groups:
+                print("Error!! groups not found")
+                continue
+
+            db_lesson = db_lessons.get(lesson.key)
+            if not db_lesson:  # a stored one has the same lesson fields
+                db_lesson = models.Lesson()  # create new
+                lesson.fill_db_object(db_lesson)
+                db_lessons[lesson.key] = db_lesson
+                created[db_lesson.pk] = db_lesson
+
+            for group in lesson.groups:
+                pair = (db_lesson.pk, group.db_object.pk)
+                if pair not in existing_groups:
+                    new_groups[pair] = lesson_groups(lesson_id=pair[0],
+                                                     group_id=pair[1])
+
+        models.Lesson.objects.bulk_create(created.values(),
+                                          batch_size=BULK_BATCH_SIZE)
+        lesson_groups.objects.bulk_create(new_groups.values(),
+                                          batch_size=BULK_BATCH_SIZE)
+        # calendars of the lesson users are updated by calendar_sync
+        models.LessonChange.record(created.keys() |
+                                   {lesson_id for lesson_id, _ in new_groups})
+
+        return dict(created=len(created), updated=0, deleted=0,
+                    groups=len(new_groups), removed_groups=0)
+
+    def update_lessons(self):
+        """Make faculty lessons of the semester equal to the parsed ones
+
+        Stored lessons are matched to parsed ones with the same week day,
+        number and subject (Lesson.match_key), so a matched lesson keeps its
+        id, meeting url and type when it moves to another room or weeks.
+        A stored lesson with the same Lesson.key is taken first. Only
+        lessons and group links that differ are written. Links to groups of
+        other faculties are left as they are, and lessons linked to them
+        are only matched by Lesson.key, rooms of other faculties do not
+        change.
+        """
+        # Lesson.match_key -> stored lessons
+        candidates, stored_ids = defaultdict(list), list()
+        for db_lesson in (models.Lesson.objects
+                          .filter(groups__specialty__faculty=self.faculty,
+                                  semester=self.semester)
+                          .select_related('subject')
+                          .distinct().order_by('pk')):
+            candidates[Lesson.db_lesson_match_key(db_lesson)].append(db_lesson)
+            stored_ids.append(db_lesson.pk)
+
+        lesson_groups = models.Lesson.groups.through
+        # lesson id -> {group id: link id} of faculty groups
+        stored_groups = defaultdict(dict)
+        other_faculties_lessons = set()
+        for link_id, lesson_id, group_id, faculty_id in (
+            lesson_groups.objects
+            .filter(lesson__in=stored_ids)
+            .values_list('id', 'lesson_id', 'group_id',
+                         'group__specialty__faculty_id')
+        ):
+            if faculty_id == self.faculty.pk:
+                stored_groups[lesson_id][group_id] = link_id
+            else:
+                other_faculties_lessons.add(lesson_id)
+
+        lessons = list()
+        for lesson in self.lessons:
+            if not lesson.groups:
+                print("Error!! groups not found")
+                continue
+            lessons.append(lesson)
+
+        matches = dict()  # parsed lesson -> stored lesson
+        for lesson in lessons:
+            for db_lesson in candidates[lesson.match_key]:
+                if Lesson.db_lesson_key(db_lesson) == lesson.key:
+                    matches[lesson] = db_lesson
+                    candidates[lesson.match_key].remove(db_lesson)
+                    break
+        for lesson in lessons:
+            options = [db_lesson for db_lesson in candidates[lesson.match_key]
+                       if db_lesson.pk not in other_faculties_lessons]
+            if lesson not in matches and options:
+                # of the same weeks first, then of the same room
+                db_lesson = max(options, key=lambda db_lesson: (
+                    db_lesson.weekfrequency == lesson.freq,
+                    db_lesson.location == lesson.location))
+                matches[lesson] = db_lesson
+                candidates[lesson.match_key].remove(db_lesson)
+
+        created, updated, new_groups, removed_groups = [], [], [], []
+        changed = set()  # ids of stored lessons with changes
+        for lesson in lessons:
+            db_lesson = matches.get(lesson)
+            if not db_lesson:
+                db_lesson = models.Lesson()  # create new
+                lesson.fill_db_object(db_lesson)
+                created.append(db_lesson)
+            else:
+                values = [getattr(db_lesson, field)
+                          for field in LESSON_FIELD_ATTNAMES]
+                lesson.fill_db_object(db_lesson)
+                if values != [getattr(db_lesson, field)
+                              for field in LESSON_FIELD_ATTNAMES]:
+                    updated.append(db_lesson)
+                    changed.add(db_lesson.pk)
+
+            groups = {group.db_object.pk for group in lesson.groups}
+            stored = stored_groups.pop(db_lesson.pk, dict())
+            new_groups += [lesson_groups(lesson_id=db_lesson.pk,
+                                         group_id=group_id)
+                           for group_id in groups - stored.keys()]
+            removed_groups += [link_id for group_id, link_id in stored.items()
+                               if group_id not in groups]
+            if groups != stored.keys():
+                changed.add(db_lesson.pk)
+
+        # lessons missing in the file and duplicates of matched lessons
+        deleted = {db_lesson.pk for db_lessons in candidates.values()
+                   for db_lesson in db_lessons}
+        for lesson_id in deleted & other_faculties_lessons:
+            removed_groups += stored_groups.pop(lesson_id, dict()).values()
+            changed.add(lesson_id)
+        deleted -= other_faculties_lessons
+
+        # calendars of the lesson users are updated by calendar_sync, with
+        # groups before and after the changes
+        models.LessonChange.record(deleted | changed)
+        models.Lesson.objects.filter(pk__in=deleted).delete()
+        lesson_groups.objects.filter(pk__in=removed_groups).delete()
+        models.Lesson.objects.bulk_create(created,
+                                          batch_size=BULK_BATCH_SIZE)
+        models.Lesson.objects.bulk_update(updated, LESSON_FIELDS,
+                                          batch_size=BULK_BATCH_SIZE)
+        lesson_groups.objects.bulk_create(new_groups,
+                                          batch_size=BULK_BATCH_SIZE)
+        models.LessonChange.record(
+            changed | {db_lesson.pk for db_lesson in created})
+
+        return dict(created=len(created), updated=len(updated),
+                    deleted=len(deleted), groups=len(new_groups),
+                    removed_groups=len(removed_groups))
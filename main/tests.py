@@ -1,3 +1,196 @@
-from django.test import TestCase
+from difflib import SequenceMatcher
+import datetime
+from unittest import mock
+import os
+import tempfile
 
-# Create your tests here.
+from django.apps import apps
+from django.db import connections
+from django.test import SimpleTestCase, TestCase
+
+from benchmarks.run import fill_database
+from benchmarks.workbook import generate_workbook, subject_names
+from main import models, schedule_file_parser
+from main.schedule_file_parser import (LESSON_NAME_SIMILARITY_THRESHOLD,
+                                       CourseMatcher, Lesson,
+                                       ScheduleFileParser, ScheduleSheet,
+                                       remove_brackets)
+from moodle.models import MdlCourse
+
+
+def generated_workbook(directory, **kwargs):
+    path = os.path.join(directory, 'schedule.xlsx')
+    generate_workbook(path, **kwargs)
+    return path
+
+
+def scan_courses(name):
+    """Course found by the linear scan CourseMatcher replaced"""
+    course, max_similarity = None, 0
+    for mdl_course in MdlCourse.objects.order_by('id'):
+        similarity = max(
+            SequenceMatcher(None, remove_brackets(mdl_course.shortname),
+                            name).ratio(),
+            SequenceMatcher(None, remove_brackets(mdl_course.fullname),
+                            name).ratio())
+        if similarity < LESSON_NAME_SIMILARITY_THRESHOLD or \
+                similarity < max_similarity:
+            continue
+        max_similarity, course = similarity, mdl_course
+    return course
+
+
+class MoodleTestCase(TestCase):
+    databases = {'default', 'moodle'}
+
+    @classmethod
+    def setUpClass(cls):
+        # Moodle tables are not managed by the project
+        connection = connections['moodle']
+        tables = connection.introspection.table_names()
+        with connection.schema_editor() as editor:
+            for model in apps.get_app_config('moodle').get_models():
+                if not model._meta.managed and \
+                        model._meta.db_table not in tables:
+                    editor.create_model(model)
+        super().setUpClass()
+
+
+class CourseMatcherTest(MoodleTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        fill_database(subjects=60, courses=300, seed=0)
+
+    def test_same_course_as_linear_scan(self):
+        with tempfile.TemporaryDirectory() as directory:
+            schedule = ScheduleSheet(generated_workbook(
+                directory, groups=20, subjects=60)).read_schedule()
+        names = {Lesson.split_info(lesson_info)[0]
+                 for _, _, _, lesson_info, _ in schedule['lessons']}
+        # names of other faculties and shortened names, close to many
+        # courses, and course names themselves, tied by equal courses
+        names.update(subject_names(60, seed=1))
+        names.update(name[:len(name) * 2 // 3] for name in list(names))
+        names.update(MdlCourse.objects.values_list('shortname', flat=True)
+                     .order_by('id')[:40])
+
+        course_matcher = CourseMatcher(stored_matches=False)
+        for name in sorted(names):
+            with self.subTest(name=name):
+                self.assertEqual(course_matcher.find(name), scan_courses(name))
+
+
+class UpdateLessonsTest(MoodleTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        for number in (1, 2):
+            models.LessonNumber.objects.create(
+                lesson_number=number, starttime=datetime.time(8 + number),
+                endtime=datetime.time(9 + number))
+        cls.faculty = models.Faculty.objects.create(name='Faculty')
+        cls.semester = models.Semester.objects.create(
+            startdate=datetime.date(2026, 9, 1),
+            enddate=datetime.date(2026, 12, 25),
+            weektype=models.Semester.WeekType.NUMERATOR)
+
+    def schedule(self, room='1 к. 101', lectures=True):
+        each_week = models.WeekFrequency.EACH_WEEK
+        lessons = [[3, 0, 2, 'Фізика (пр)\n2 к. 205', each_week]]
+        if lectures:
+            lessons += [[column, 0, 1, f'Математика (л)\n{room}', each_week]
+                        for column in (3, 4)]
+        return dict(groups=[[3, '1 курс', '121', '1 група'],
+                            [4, '1 курс', '121', '2 група']],
+                    lessons=lessons)
+
+    def import_schedule(self, schedule):
+        return ScheduleFileParser(
+            None, self.faculty, self.semester, schedule
+        ).serialize_to_db(incremental=True)
+
+    def test_same_file_writes_nothing(self):
+        self.import_schedule(self.schedule())
+        self.assertEqual(self.import_schedule(self.schedule()),
+                         dict(created=0, updated=0, deleted=0, groups=0,
+                              removed_groups=0))
+
+    def test_room_change_updates_lesson(self):
+        self.import_schedule(self.schedule())
+        lecture = models.Lesson.objects.get(subject__title__startswith='Математика')
+        lecture.meetingurl = 'https://meet.example/lecture'
+        lecture.save()
+
+        result = self.import_schedule(self.schedule(room='3 к. 310'))
+        self.assertEqual((result['created'], result['updated'],
+                          result['deleted']), (0, 1, 0))
+        moved = models.Lesson.objects.get(subject__title__startswith='Математика')
+        self.assertEqual(moved.pk, lecture.pk)
+        self.assertEqual(moved.location, '3 к. 310')
+        self.assertEqual(moved.meetingurl, 'https://meet.example/lecture')
+
+    def test_lesson_of_other_faculty_keeps_its_groups(self):
+        self.import_schedule(self.schedule())
+        lecture = models.Lesson.objects.get(subject__title__startswith='Математика')
+        other_faculty = models.Faculty.objects.create(name='Other faculty')
+        other_group = models.Group.objects.create(
+            name='other', year=2026, number=1,
+            type=models.Group.Type.BACHELOR,
+            specialty=models.Specialty.objects.create(
+                code='073', faculty=other_faculty))
+        lecture.groups.add(other_group)
+
+        result = self.import_schedule(self.schedule(lectures=False))
+        self.assertEqual((result['deleted'], result['removed_groups']),
+                         (0, 2))
+        self.assertQuerysetEqual(
+            models.Lesson.objects.get(pk=lecture.pk).groups.all(),
+            [other_group])
+
+
+class GeneratedSheetTestCase(SimpleTestCase):
+    """Compares reads of a generated sheet with the serial full read"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.path = generated_workbook(cls.directory.name, groups=20)
+        cls.sheet = ScheduleSheet(cls.path)
+        cls.schedule = cls.sheet.read_schedule()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+
+class StreamedSheetTest(GeneratedSheetTestCase):
+
+    def test_same_week_days(self):
+        self.assertEqual(ScheduleSheet(self.path, streaming=True)
+                         .week_day_ranges, self.sheet.week_day_ranges)
+
+    def test_same_schedule(self):
+        self.assertEqual(ScheduleSheet(self.path, streaming=True)
+                         .read_schedule(), self.schedule)
+
+
+class ParallelReadTest(GeneratedSheetTestCase):
+
+    def test_same_schedule(self):
+        self.assertEqual(ScheduleSheet(self.path).read_schedule(workers=2),
+                         self.schedule)
+
+    def test_more_workers_than_columns(self):
+        self.assertEqual(ScheduleSheet(self.path).read_schedule(workers=30),
+                         self.schedule)
+
+    def test_worker_error_releases_sheet(self):
+        sheet = ScheduleSheet(self.path)
+        with mock.patch.object(ScheduleSheet, 'read_columns',
+                               side_effect=ValueError('broken cell')):
+            with self.assertRaises(ValueError):
+                sheet.read_schedule(workers=2)
+        self.assertIsNone(schedule_file_parser.forked_sheet)
@@ -1,10 +1,11 @@
 from typing import Any, Dict
 
 from django import forms
-from django.http import HttpResponse, HttpResponseRedirect
-from django.shortcuts import render, redirect
-from django.db.models import Q, Count
-from django.views.generic import TemplateView
+from django.http import (Http404, HttpResponse, HttpResponseRedirect,
+                         JsonResponse)
+from django.shortcuts import render, redirect, get_object_or_404
+from django.urls import reverse
+from django.views.generic import TemplateView, View
 from django.views.generic.edit import FormView
 from django.contrib.auth.mixins import UserPassesTestMixin, LoginRequiredMixin
 
@@ -12,10 +13,8 @@ from allauth.socialaccount.models import SocialAccount
 
 from schedule_nubip.settings import DEBUG
 
-from main.models import Lesson
-from moodle.models import MdlUser, MdlRoleAssignments
-
-from main.g_calendar import Student, Teacher
+from main.calendar_feed import feed_person, feed_response
+from main.models import CalendarFeed, CalendarSyncJob, Lesson, LessonChange
 
 SCOPES = ['https://www.googleapis.com/auth/calendar.events.owned']
 
@@ -42,6 +41,7 @@ class BatchMeetUrlSetView(LoginRequiredMixin, UserPassesTestMixin, TemplateView)
             if form.is_valid():
                 custom_data = form.cleaned_data['meeting_url']
                 Lesson.objects.filter(id__in=lesson_ids).update(meetingurl=custom_data)
+                LessonChange.record(lesson_ids)
                 return HttpResponseRedirect('/admin/main/lesson/')
 
         return HttpResponse(status=406)
@@ -61,6 +61,14 @@ class FillCalendarView(LoginRequiredMixin, TemplateView):
         update = self.request.GET.get('update')
         delete = self.request.GET.get('delete')
         if not update and not delete:
+            # show the last job, it may still run
+            context['job'] = (CalendarSyncJob.objects
+                              .filter(user=self.request.user)
+                              .order_by('-pk').first())
+            feed, _ = CalendarFeed.objects.get_or_create(
+                user=self.request.user)
+            context['feed_url'] = self.request.build_absolute_uri(
+                reverse('calendar_feed', args=[feed.token]))
             return context
 
         email = self.request.user.email
@@ -69,33 +77,31 @@ class FillCalendarView(LoginRequiredMixin, TemplateView):
             if not email:
                 email = self.request.user.email
 
-        # search user email in db
-        try:
-            user = MdlUser.objects.get(email=email)
-        except MdlUser.DoesNotExist:
-            context['message'] = f'Email {email} was not found in database, please use another email or contact administrator'
-            return context
+        # calendar is updated by calendar_sync command
+        action = CalendarSyncJob.Action.UPDATE if update \
+            else CalendarSyncJob.Action.DELETE
+        context['job'] = CalendarSyncJob.enqueue(self.request.user, action,
+                                                 email)
+        return context
 
-        person_obj = self.create_person(user)
-        # create google calendar events for user
-        if update:
-            context['message'] = person_obj.update_calendar()
-        elif delete:
-            print('deleting calendar')
-            context['message'] = person_obj.delete_calendar()
 
-        return context
+class CalendarSyncStatusView(LoginRequiredMixin, View):
+    """State of a calendar update job polled by the index page"""
+
+    def get(self, request, pk, *args, **kwargs):
+        job = get_object_or_404(CalendarSyncJob, pk=pk, user=request.user)
+        return JsonResponse({'status': job.get_status_display(),
+                             'finished': job.finished,
+                             'message': job.message})
 
-    def create_person(self, user):
-        role_assignments = (
-            MdlRoleAssignments.objects.filter(userid=user)
-            .annotate(teaches=Count(1, filter=Q(roleid__shortname='editingteacher')),
-                      studying=Count(1, filter=Q(roleid__shortname='student')))
-            .first()
-        )
 
-        if role_assignments.teaches > role_assignments.studying:
-            return Teacher(self.request.user, user)
-        else:
-            return Student(self.request.user, user)
+class CalendarFeedView(View):
+    """iCalendar feed polled by calendar clients, the token authorizes it"""
 
+    def get(self, request, token, *args, **kwargs):
+        feed = get_object_or_404(
+            CalendarFeed.objects.select_related('user', 'group'), token=token)
+        person = feed_person(feed)
+        if person is None:
+            raise Http404('Feed lessons were not found')
+        return feed_response(request, feed, person)
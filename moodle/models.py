@@ -9,6 +9,7 @@ class DbRelatedManager(models.Manager):
 class MdlCohort(models.Model):
     id = models.BigAutoField(primary_key=True)
     name = models.CharField(max_length=254)
+    timemodified = models.BigIntegerField()
 
     objects = DbRelatedManager()
 
@@ -23,6 +24,7 @@ class MdlCohortMembers(models.Model):
         MdlCohort, on_delete=models.CASCADE, db_column='cohortid')
     userid = models.ForeignKey(
         'MdlUser', on_delete=models.CASCADE, db_column='userid')
+    timeadded = models.BigIntegerField()
 
     objects = DbRelatedManager()
 
@@ -36,6 +38,7 @@ class MdlCourse(models.Model):
     id = models.BigAutoField(primary_key=True)
     fullname = models.CharField(max_length=254)
     shortname = models.CharField(max_length=255)
+    timemodified = models.BigIntegerField()
 
     objects = DbRelatedManager()
 
@@ -51,6 +54,7 @@ class MdlUser(models.Model):
     firstname = models.CharField(max_length=100)
     lastname = models.CharField(max_length=100)
     email = models.CharField(max_length=100)
+    timemodified = models.BigIntegerField()
 
     objects = DbRelatedManager()
 
@@ -67,6 +71,7 @@ class MdlUserEnrolments(models.Model):
         'MdlEnrol', on_delete=models.CASCADE, db_column='enrolid')
     userid = models.ForeignKey(
         'MdlUser', on_delete=models.CASCADE, db_column='userid')
+    timemodified = models.BigIntegerField()
 
     objects = DbRelatedManager()
 
@@ -106,6 +111,7 @@ class MdlRoleAssignments(models.Model):
         MdlRole, on_delete=models.CASCADE, db_column='roleid')
     userid = models.ForeignKey(
         MdlUser, on_delete=models.CASCADE, db_column='userid')
+    timemodified = models.BigIntegerField()
 
     objects = DbRelatedManager()
 
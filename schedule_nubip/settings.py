@@ -158,6 +158,14 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# Parsed schedule files by content hash, lets re-imports skip the workbook
+SCHEDULE_CACHE_DIR = BASE_DIR / 'cache' / 'schedules'
+
+# Key file of the service account owning shared calendars of groups, students
+# subscribe to them instead of getting copies of group lessons. Without it
+# lessons are copied to every student calendar.
+GOOGLE_SERVICE_ACCOUNT_FILE = env('GOOGLE_SERVICE_ACCOUNT_FILE', default='')
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
 
@@ -169,6 +177,8 @@ SOCIALACCOUNT_PROVIDERS = {
             'profile',
             'email',
             'https://www.googleapis.com/auth/calendar.events.owned',
+            # subscribing to group calendars
+            'https://www.googleapis.com/auth/calendar.calendarlist',
         ],
         'AUTH_PARAMS': {
             'access_type': 'online',
@@ -19,7 +19,8 @@ from django.urls import path, include
 from django.views.generic import TemplateView
 from django.contrib.auth.views import LogoutView, LoginView
 
-from main.views import FillCalendarView, BatchMeetUrlSetView
+from main.views import (FillCalendarView, BatchMeetUrlSetView,
+                        CalendarFeedView, CalendarSyncStatusView)
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -29,5 +30,9 @@ urlpatterns = [
     path('accounts/', include('allauth.urls')),
     path('__debug__/', include('debug_toolbar.urls')),
     path('logout', LogoutView.as_view(), name='logout'),
+    path('calendar_sync/<int:pk>/', CalendarSyncStatusView.as_view(),
+         name='calendar_sync_status'),
+    path('feeds/<str:token>.ics', CalendarFeedView.as_view(),
+         name='calendar_feed'),
     path('', FillCalendarView.as_view(template_name="index.html")),
 ]